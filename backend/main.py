@@ -1,63 +1,102 @@
 """
 FastAPI Backend for Land Cover Change Analysis with Fragstats Integration
 To run:
-    pip install fastapi uvicorn rasterio geopandas numpy pandas scipy xlsxwriter matplotlib contextily rpy2
+    pip install fastapi uvicorn rasterio shapely pyproj numpy pandas scipy xlsxwriter matplotlib contextily rpy2 pylandstats
     uvicorn main:app --host 0.0.0.0 --port 8000
 """
 
 import os
+import asyncio
+import atexit
+import contextlib
 import io
+import hashlib
+import importlib.util
 import json
+import multiprocessing
 import shutil
 import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
-from typing import Any, Dict, List
+from functools import lru_cache
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, NamedTuple, Optional
+import anyio
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 import rasterio
 import rasterio.warp
-from rasterio.mask import mask
+import rasterio.windows
+import shapely
+from shapely.geometry import shape
+from pyproj import Transformer
+from rasterio import features
 from rasterio.transform import array_bounds
+from rasterio.windows import WindowError
 from scipy.stats import chi2_contingency
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
 # ============================================================
 # === IMPORTS: VISUALIZATION & RPY2 ==========================
 # ============================================================
-try:
+# matplotlib, contextily, rpy2 and pylandstats are only probed here and
+# imported on first use, so startup and /health never pay for loading them
+# (rpy2 in particular boots an embedded R interpreter)
+HAS_MATPLOTLIB = importlib.util.find_spec("matplotlib") is not None
+HAS_CONTEXTILY = importlib.util.find_spec("contextily") is not None
+
+
+@lru_cache(maxsize=None)
+def _pyplot():
     import matplotlib
 
     matplotlib.use("Agg")
     import matplotlib.pyplot as plt
     import matplotlib.colors as mcolors
 
-    HAS_MATPLOTLIB = True
-except ImportError:
-    HAS_MATPLOTLIB = False
-
-try:
-    import contextily as ctx
+    # Defaults for the per-target change maps; savefig crops to the drawn
+    # artists, so no separate tight_layout pass is needed
+    matplotlib.rcParams.update(
+        {"figure.figsize": (10, 10), "savefig.dpi": 300, "savefig.bbox": "tight"}
+    )
+    return plt, mcolors
 
-    HAS_CONTEXTILY = True
-except ImportError:
-    HAS_CONTEXTILY = False
 
-# RPY2 Imports for Fragstats
+# Numba for the per-pixel histogram kernels (falls back to NumPy)
 try:
-    import rpy2.robjects as ro
-    from rpy2.robjects import StrVector, IntVector
-    from rpy2.robjects.packages import importr
-    from rpy2.robjects import pandas2ri
+    import numba
+    from numba import njit, prange
 
-    HAS_RPY2 = True
+    HAS_NUMBA = True
 except ImportError:
-    HAS_RPY2 = False
-    print("WARNING: rpy2 not installed. Fragstats analysis will be skipped.")
+    HAS_NUMBA = False
+
+if HAS_NUMBA and "NUMBA_THREADING_LAYER" not in os.environ:
+    # The kernels are launched from request worker threads, so the layer has
+    # to be thread-safe: workqueue aborts on concurrent launches and TBB hangs
+    # at interpreter shutdown. Only read at the first parallel launch.
+    numba.config.THREADING_LAYER = "omp"
+
+# RPY2 for Fragstats, with pure-Python landscape metrics when R is not available
+HAS_RPY2 = importlib.util.find_spec("rpy2") is not None
+HAS_PYLANDSTATS = importlib.util.find_spec("pylandstats") is not None
+if not HAS_RPY2:
+    if HAS_PYLANDSTATS:
+        print("WARNING: rpy2 not installed. Fragstats will use pylandstats.")
+    else:
+        print("WARNING: rpy2 not installed. Fragstats analysis will be skipped.")
 
 # ============================================================
 # === SETUP ==================================================
@@ -78,6 +117,54 @@ app.add_middleware(
 
 BASE_PATH = "/Users/hoanganh692004/Desktop/geojson"
 
+# GDAL tuning for the NLCD reads: a 1 GB block cache, no sibling-file
+# directory scan on every open, and multithreaded tile decompression.
+# setdefault so values exported by the deployment still win.
+os.environ.setdefault("GDAL_CACHEMAX", "1024")
+os.environ.setdefault("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+
+# Result workbooks are written strictly row by row (see write_frame), so
+# xlsxwriter can flush each row instead of holding every sheet in memory.
+# No cell is meant as a hyperlink; skip the per-string URL regex scan.
+XLSX_ENGINE_KWARGS = {"options": {"constant_memory": True, "strings_to_urls": False}}
+
+# Outputs that are already deflated internally; re-compressing them in the
+# result ZIP burns CPU for no size gain
+PRECOMPRESSED_SUFFIXES = (".png", ".xlsx", ".tif", ".zip")
+# Members below this size are read and compressed in a single call
+ZIP_SMALL_FILE_BYTES = 1024 * 1024
+
+# Cropped NLCD rasters are small integer codes: tiled ZSTD with horizontal
+# differencing shrinks them several-fold and decodes faster than DEFLATE when
+# Fragstats reads them back. BigTIFF only kicks in for very large AOIs.
+CROP_TIFF_PROFILE = {
+    "driver": "GTiff",
+    "count": 1,
+    "compress": "zstd",
+    "zstd_level": 3,
+    "predictor": 2,
+    "bigtiff": "IF_SAFER",
+    "tiled": True,
+    "blockxsize": 256,
+    "blockysize": 256,
+    "num_threads": "ALL_CPUS",
+}
+
+# Cropped bands are cached here between requests, keyed by AOI and raster
+# (see crop_cache_path); delete the directory to clear it
+CROP_CACHE_DIR = os.environ.get(
+    "NLCD_CROP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nlcd_crop_cache")
+)
+# Least recently used entries are pruned once the cache grows past this;
+# 0 disables the cache
+CROP_CACHE_MAX_BYTES = int(os.environ.get("NLCD_CROP_CACHE_MAX_BYTES", 2 * 1024**3))
+# Temp files older than this are leftovers from a crashed write
+CROP_CACHE_TMP_MAX_AGE_S = 3600
+# Bump when the cropping rules change so entries written by an older build
+# are never served (v2: source nodata is zeroed like rasterio.mask.mask)
+CROP_CACHE_VERSION = 2
+
 # ============================================================
 # === DICTIONARIES & CONFIGS =================================
 # ============================================================
@@ -127,6 +214,8 @@ RECLASS_LABELS = {
     0: "0-empty",
 }
 
+# Codes not listed here (0 outside the AOI, nodata, anything unexpected)
+# reclassify to 0, "0-empty", so the result always stays within classes 0-7
 RECLASS_DICT = {
     11: 1,
     12: 1,
@@ -150,6 +239,45 @@ RECLASS_DICT = {
     31: 7,
 }
 
+
+def _build_lut(mapping: dict) -> np.ndarray:
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[list(mapping)] = list(mapping.values())
+    return lut
+
+
+def _build_sorted_mapping(mapping: dict):
+    keys = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+    vals = np.fromiter(mapping.values(), dtype=np.uint8, count=len(mapping))
+    order = np.argsort(keys)
+    return keys[order], vals[order]
+
+
+# NLCD codes all fit in a byte, so reclassification is a single gather
+_RECLASS_LUT = _build_lut(RECLASS_DICT)
+# Sorted keys/values for inputs wider than a byte (searchsorted fallback)
+_RECLASS_KEYS, _RECLASS_VALS = _build_sorted_mapping(RECLASS_DICT)
+
+
+def _build_label_array(label_dict: dict) -> np.ndarray:
+    labels = np.array([f"{code}-empty" for code in range(256)], dtype=object)
+    labels[list(label_dict)] = list(label_dict.values())
+    return labels
+
+
+# Code-indexed label lookups, so labelling a column is a gather, not a dict hit
+NLCD_LABEL_ARR = _build_label_array(NLCD_LABELS)
+RECLASS_LABEL_ARR = _build_label_array(RECLASS_LABELS)
+
+
+def _label_array_for(label_dict: dict) -> np.ndarray:
+    if label_dict is NLCD_LABELS:
+        return NLCD_LABEL_ARR
+    if label_dict is RECLASS_LABELS:
+        return RECLASS_LABEL_ARR
+    return _build_label_array(label_dict)
+
+
 LC_NAMES = {
     1: "Water",
     2: "Developed Area",
@@ -171,10 +299,48 @@ CLASS_COLORS = {
 }
 
 
+# Reclass class names for the Fragstats tables, keyed by the class code as str
+FRAGSTATS_CLASS_LABELS = {
+    "1": "Water",
+    "2": "Developed",
+    "3": "Forest",
+    "4": "Shrub",
+    "5": "Herbaceous",
+    "6": "Nonvascular",
+    "7": "Sparse vegetation",
+}
+
+# pylandstats metric -> landscapemetrics name, for the non-R Fragstats path
+PLS_CLASS_METRICS = {
+    "total_area": "ca",
+    "proportion_of_landscape": "pland",
+    "patch_density": "pd",
+    "largest_patch_index": "lpi",
+    "edge_density": "ed",
+    "shape_index_mn": "shape_mn",
+}
+PLS_LANDSCAPE_METRICS = {
+    "number_of_patches": "np",
+    "patch_density": "pd",
+    "shannon_diversity_index": "shdi",
+    "contagion": "contag",
+}
+
+CHANGE_CLASS_EDGES = np.array([1.0, 10.0, 25.0])
+CHANGE_CLASS_NAMES = np.array(["Very Low", "Low", "Moderate", "High"])
+
+
 class AnalysisRequest(BaseModel):
     geojson: Dict[str, Any]
     year1: int
     year2: int
+    # The cropped GeoTIFFs are always written (Fragstats reads them); this only
+    # controls whether they are shipped in the ZIP
+    include_cropped_rasters: bool = True
+    # The CSVs and the .xlsx workbooks carry the same tables; either can be
+    # skipped when the caller only reads the other
+    include_xlsx: bool = True
+    include_csv: bool = True
 
 
 # ============================================================
@@ -191,39 +357,281 @@ def get_tif_path(year: int) -> str:
     return path
 
 
-def crop_raster_in_memory(raster_path: str, geoms: list):
-    with rasterio.open(raster_path) as src:
-        cropped_data, cropped_transform = mask(src, geoms, crop=True, nodata=0)
-        cropped_meta = src.meta.copy()
-    cropped_meta.update(
+class RasterGrid(NamedTuple):
+    crs: Any
+    transform: Any
+    width: int
+    height: int
+    meta: dict
+    # WGS84 -> raster CRS, or None when the raster is already EPSG:4326
+    from_wgs84: Optional[Transformer]
+
+
+@lru_cache(maxsize=64)
+def _raster_grid(path: str, mtime_ns: int) -> RasterGrid:
+    with rasterio.open(path) as src:
+        if src.crs == "EPSG:4326":
+            from_wgs84 = None
+        else:
+            from_wgs84 = Transformer.from_crs(
+                "EPSG:4326", src.crs.to_wkt(), always_xy=True
+            )
+        return RasterGrid(
+            src.crs, src.transform, src.width, src.height, src.meta, from_wgs84
+        )
+
+
+def raster_grid(path: str) -> RasterGrid:
+    # NLCD rasters don't change between requests; the mtime key catches a
+    # replaced file without reopening it every time
+    return _raster_grid(path, os.stat(path).st_mtime_ns)
+
+
+class AOIContext(NamedTuple):
+    window: Any
+    transform: Any
+    mask_bool: np.ndarray
+    height: int
+    width: int
+
+
+def build_aoi_mask(raster_path: str, geoms: list) -> AOIContext:
+    """
+    Rasterize the AOI (shapely geometries in EPSG:4326, as parsed from the
+    request GeoJSON) once on the NLCD grid. The read window, its transform
+    and the inside-polygon mask are shared by both years' crops, so they are
+    pixel-aligned without any resampling.
+    """
+    grid = raster_grid(raster_path)
+    transformer = grid.from_wgs84
+    if transformer is not None:
+        geoms = list(
+            shapely.transform(
+                geoms,
+                lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])),
+            )
+        )
+    try:
+        # geometry_window only needs the grid's transform, width and height
+        window = features.geometry_window(grid, geoms)
+    except WindowError:
+        raise ValueError("Input shapes do not overlap raster.")
+    window_transform = rasterio.windows.transform(window, grid.transform)
+    height, width = int(window.height), int(window.width)
+    inside = features.geometry_mask(
+        geoms, out_shape=(height, width), transform=window_transform, invert=True
+    )
+    return AOIContext(window, window_transform, inside, height, width)
+
+
+def cropped_meta(src_meta: dict, aoi: AOIContext) -> dict:
+    meta = src_meta.copy()
+    meta.update(
         {
-            "height": cropped_data.shape[1],
-            "width": cropped_data.shape[2],
-            "transform": cropped_transform,
+            "count": 1,
+            "height": aoi.height,
+            "width": aoi.width,
+            "dtype": "uint8",
+            "transform": aoi.transform,
         }
     )
-    return cropped_data, cropped_meta
+    return meta
 
 
-def apply_labels(df: pd.DataFrame, label_dict: dict) -> pd.DataFrame:
-    df_new = df.copy()
-    df_new.index = [label_dict.get(i, f"{i}-empty") for i in df.index]
-    df_new.columns = [label_dict.get(j, f"{j}-empty") for j in df.columns]
-    return df_new
+def crop_raster_in_memory(src, aoi: AOIContext):
+    # NLCD codes fit in a byte; keep them that way through the whole pipeline.
+    # GDAL converts while reading, so a wider source dtype never needs a
+    # second full-size array
+    band = src.read(1, window=aoi.window, out_dtype=np.uint8)
+    # Same result as mask(..., nodata=0): pixels outside the polygons and the
+    # source's own nodata/masked pixels (NLCD 250) inside them both become 0
+    valid = src.read_masks(1, window=aoi.window) != 0
+    valid &= aoi.mask_bool
+    band[~valid] = 0
+    return band, cropped_meta(src.meta, aoi)
 
 
-def apply_reclass_labels(df: pd.DataFrame, label_dict: dict) -> pd.DataFrame:
-    df_new = df.copy()
-    df_new.index = [label_dict.get(i, f"{i}-empty") for i in df.index]
-    df_new.columns = [label_dict.get(j, f"{j}-empty") for j in df.columns]
+def apply_labels(df: pd.DataFrame, label_dict: dict) -> pd.DataFrame:
+    # Only the axis labels change, so share the values block with df
+    labels = _label_array_for(label_dict)
+    df_new = df.copy(deep=False)
+    df_new.index = labels[df.index.to_numpy(dtype=np.intp)]
+    df_new.columns = labels[df.columns.to_numpy(dtype=np.intp)]
     return df_new
 
 
 def reclassify(arr: np.ndarray, mapping: dict) -> np.ndarray:
-    out = np.copy(arr)
-    for k, v in mapping.items():
-        out[arr == k] = v
-    return out
+    """Map codes through mapping as uint8; codes missing from it become 0."""
+    if arr.dtype == np.uint8:
+        lut = _RECLASS_LUT if mapping is RECLASS_DICT else _build_lut(mapping)
+        # Plain 1-D gather; np.take is cheaper than fancy indexing here
+        return np.take(lut, arr)
+    # Wider dtypes: one searchsorted pass over the sorted keys, misses -> 0
+    if mapping is RECLASS_DICT:
+        keys, vals = _RECLASS_KEYS, _RECLASS_VALS
+    else:
+        keys, vals = _build_sorted_mapping(mapping)
+    idx = np.searchsorted(keys, arr).clip(max=len(keys) - 1)
+    return np.where(keys[idx] == arr, vals[idx], np.uint8(0))
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def histogram2d_u8(a1, a2, out, n_chunks):
+        # One local 256x256 histogram per chunk, reduced into out at the end,
+        # so the pass needs neither atomics nor a packed temporary array
+        n = a1.size
+        step = (n + n_chunks - 1) // n_chunks
+        local = np.zeros((n_chunks, 256, 256), dtype=np.int64)
+        for c in prange(n_chunks):
+            for i in range(c * step, min((c + 1) * step, n)):
+                local[c, a1[i], a2[i]] += 1
+        for c in range(n_chunks):
+            out += local[c]
+
+    @njit(parallel=True, cache=True)
+    def histogram2d_reclass_u8(a1, a2, lut, out, r1, r2, n_chunks):
+        # histogram2d_u8 that also writes both rasters through lut, so every
+        # pixel pair is read once for the counts and the reclassified outputs
+        n = a1.size
+        step = (n + n_chunks - 1) // n_chunks
+        local = np.zeros((n_chunks, 256, 256), dtype=np.int64)
+        for c in prange(n_chunks):
+            for i in range(c * step, min((c + 1) * step, n)):
+                x = a1[i]
+                y = a2[i]
+                local[c, x, y] += 1
+                r1[i] = lut[x]
+                r2[i] = lut[y]
+        for c in range(n_chunks):
+            out += local[c]
+
+
+# Serializes the first launch (which loads the threading layer), and every
+# launch if the layer is not thread-safe (NUMBA_THREADING_LAYER=workqueue)
+_NUMBA_LOCK = threading.Lock()
+_numba_layer: Optional[str] = None  # "" once no layer could be loaded
+
+
+def run_parallel_kernel(kernel, *args) -> bool:
+    """
+    Launch a parallel Numba kernel with one chunk per thread. Returns False
+    if no threading layer can be loaded, so the caller takes the NumPy path.
+    """
+    global _numba_layer
+    if _numba_layer not in (None, "", "workqueue"):
+        kernel(*args, numba.get_num_threads())
+        return True
+    with _NUMBA_LOCK:
+        if _numba_layer == "":
+            return False
+        try:
+            kernel(*args, numba.get_num_threads())
+        except ValueError as e:
+            if "threading layer" not in str(e):
+                raise
+            print(f"WARNING: Numba threading layer unavailable, using NumPy: {e}")
+            _numba_layer = ""
+            return False
+        _numba_layer = numba.threading_layer()
+    return True
+
+
+def transition_counts(
+    a1: np.ndarray, a2: np.ndarray, n_classes: Optional[int] = None
+) -> np.ndarray:
+    """
+    Full square (from, to) pixel histogram of two co-registered class rasters
+    in a single pass: the Numba kernel for uint8 input (256x256), otherwise
+    np.bincount over packed codes.
+    """
+    a1 = np.asarray(a1).ravel()
+    a2 = np.asarray(a2).ravel()
+    if HAS_NUMBA and a1.dtype == np.uint8 and a2.dtype == np.uint8:
+        counts = np.zeros((256, 256), dtype=np.int64)
+        if run_parallel_kernel(histogram2d_u8, a1, a2, counts):
+            return counts
+    if n_classes is None:
+        n_classes = int(max(a1.max(initial=0), a2.max(initial=0))) + 1
+    # Widen only the packed code; uint8 inputs pack into uint16 for K <= 256
+    packed_dtype = np.uint16 if n_classes <= 256 else np.int64
+    packed = a1.astype(packed_dtype) * packed_dtype(n_classes) + a2
+    return np.bincount(packed, minlength=n_classes * n_classes).reshape(
+        n_classes, n_classes
+    )
+
+
+def transition_counts_reclass(a1: np.ndarray, a2: np.ndarray):
+    """
+    Original (from, to) histogram of two co-registered NLCD rasters plus both
+    rasters reclassified with RECLASS_DICT. With Numba and uint8 input this
+    is one fused pass; otherwise a LUT gather per raster and a histogram.
+    """
+    if HAS_NUMBA and a1.dtype == np.uint8 and a2.dtype == np.uint8:
+        r1 = np.empty_like(a1, order="C")
+        r2 = np.empty_like(a2, order="C")
+        counts = np.zeros((256, 256), dtype=np.int64)
+        if run_parallel_kernel(
+            histogram2d_reclass_u8,
+            a1.ravel(),
+            a2.ravel(),
+            _RECLASS_LUT,
+            counts,
+            r1.ravel(),
+            r2.ravel(),
+        ):
+            return counts, r1, r2
+    r1 = reclassify(a1, RECLASS_DICT)
+    r2 = reclassify(a2, RECLASS_DICT)
+    return transition_counts(a1, a2), r1, r2
+
+
+def collapse_transition(
+    counts: np.ndarray, lut: np.ndarray, n_classes: int
+) -> np.ndarray:
+    # Reclassified pairs are (lut[a], lut[b]) of the original pairs, so the
+    # reclass histogram is the original one summed over a one-hot code map
+    onehot = np.zeros((counts.shape[0], n_classes), dtype=counts.dtype)
+    onehot[np.arange(counts.shape[0]), lut[: counts.shape[0]]] = 1
+    return onehot.T @ counts @ onehot
+
+
+def counts_frame(counts: np.ndarray) -> pd.DataFrame:
+    # Keep only the codes that occur, matching pd.crosstab
+    rows = np.flatnonzero(counts.sum(axis=1))
+    cols = np.flatnonzero(counts.sum(axis=0))
+    return pd.DataFrame(counts[np.ix_(rows, cols)], index=rows, columns=cols)
+
+
+def row_percent(df: pd.DataFrame) -> pd.DataFrame:
+    # Row-normalized percentages on the raw array; empty rows stay 0, not NaN
+    arr = df.to_numpy(dtype=np.float64)
+    row_sums = arr.sum(axis=1, keepdims=True)
+    row_sums[row_sums == 0] = 1
+    return pd.DataFrame(
+        np.round(arr / row_sums * 100, 2), index=df.index, columns=df.columns
+    )
+
+
+def ranked_transitions(
+    matrix: pd.DataFrame, from_colname: str, value_colname: str
+) -> pd.DataFrame:
+    """
+    Long From/To/value table of the positive cells of a transition matrix,
+    largest first. Ties keep the column-by-column order of the matrix.
+    """
+    vals = matrix.to_numpy()
+    cols, rows = np.nonzero(vals.T > 0)
+    values = vals[rows, cols]
+    order = np.argsort(-values, kind="stable")
+    return pd.DataFrame(
+        {
+            from_colname: matrix.index.to_numpy()[rows[order]],
+            "To": matrix.columns.to_numpy()[cols[order]],
+            value_colname: values[order],
+        }
+    )
 
 
 def normalize_and_rank(
@@ -232,171 +640,179 @@ def normalize_and_rank(
     use_nlcd_labels: bool = False,
     use_reclass_labels: bool = False,
 ):
-    tm = transition_matrix.copy()
-    np.fill_diagonal(tm.values, 0)
+    vals = transition_matrix.to_numpy(copy=True)
+    np.fill_diagonal(vals, 0)
+    tm = pd.DataFrame(
+        vals, index=transition_matrix.index, columns=transition_matrix.columns
+    )
     total_changed = tm.sum().sum()
     if total_changed == 0:
         return None, None
     change_pct = ((tm / total_changed) * 100).round(2)
     from_colname = "From"
     change_pct = change_pct.rename_axis(from_colname)
-    flat = change_pct.reset_index().melt(
-        id_vars=from_colname, var_name="To", value_name="Percent"
-    )
-    flat = flat[flat["Percent"] > 0].sort_values("Percent", ascending=False)
-    flat["Change_Class"] = pd.cut(
-        flat["Percent"],
-        bins=[0, 1, 10, 25, 100],
-        labels=["Very Low", "Low", "Moderate", "High"],
-    )
-    norm_labeled = change_pct.copy()
+    flat = ranked_transitions(change_pct, from_colname, "Percent")
+    # Right-closed bins (0, 1], (1, 10], (10, 25], (25, 100] as with pd.cut
+    flat["Change_Class"] = CHANGE_CLASS_NAMES[
+        np.searchsorted(CHANGE_CLASS_EDGES, flat["Percent"].to_numpy(), side="left")
+    ]
+    norm_labeled = change_pct.copy(deep=False)
+    label_dict = None
     if use_nlcd_labels:
-        norm_labeled.index = [
-            NLCD_LABELS.get(int(x), "0-empty") for x in change_pct.index
-        ]
-        norm_labeled.columns = [
-            NLCD_LABELS.get(int(x), "0-empty") for x in change_pct.columns
-        ]
+        label_dict = NLCD_LABELS
     if use_reclass_labels:
-        norm_labeled.index = [
-            RECLASS_LABELS.get(int(x), "0-empty") for x in change_pct.index
-        ]
-        norm_labeled.columns = [
-            RECLASS_LABELS.get(int(x), "0-empty") for x in change_pct.columns
-        ]
-    if use_nlcd_labels:
-        flat["From_description"] = flat[from_colname].apply(
-            lambda x: NLCD_LABELS.get(int(x), "0-empty")
-        )
-        flat["To_description"] = flat["To"].apply(
-            lambda x: NLCD_LABELS.get(int(x), "0-empty")
-        )
-    if use_reclass_labels:
-        flat["From_description"] = flat[from_colname].apply(
-            lambda x: RECLASS_LABELS.get(int(x), "0-empty")
-        )
-        flat["To_description"] = flat["To"].apply(
-            lambda x: RECLASS_LABELS.get(int(x), "0-empty")
-        )
-    if use_nlcd_labels or use_reclass_labels:
-        flat["Label"] = flat.apply(
-            lambda r: f"{r['From_description']} to {r['To_description']}", axis=1
-        )
+        label_dict = RECLASS_LABELS
+    if label_dict is not None:
+        # Resolve each distinct code once and reuse it for both axes and flat
+        codes = change_pct.index.union(change_pct.columns)
+        code_labels = pd.Series(codes.map(label_dict), index=codes).fillna("0-empty")
+        norm_labeled.index = code_labels.reindex(change_pct.index).to_numpy()
+        norm_labeled.columns = code_labels.reindex(change_pct.columns).to_numpy()
+        flat["From_description"] = flat[from_colname].map(code_labels)
+        flat["To_description"] = flat["To"].map(code_labels)
+        flat["Label"] = flat["From_description"] + " to " + flat["To_description"]
     return norm_labeled, flat
 
 
 def chi_square_summary(
     tm: pd.DataFrame, use_nlcd_labels: bool = False, use_reclass_labels: bool = False
 ):
-    chi2, p, dof, exp = chi2_contingency(tm.values)
+    # Empty rows/columns make expected frequencies zero, which scipy rejects
+    nonempty_rows = tm.to_numpy().sum(axis=1) > 0
+    nonempty_cols = tm.to_numpy().sum(axis=0) > 0
+    if not (nonempty_rows.all() and nonempty_cols.all()):
+        tm = tm.loc[nonempty_rows, nonempty_cols]
+    if min(tm.shape) < 2:
+        # No degrees of freedom: expected equals observed, nothing to test
+        chi2, p, exp = 0.0, 1.0, tm.to_numpy(dtype=float)
+    else:
+        chi2, p, dof, exp = chi2_contingency(tm.values)
+
+    def describe(codes: pd.Series) -> pd.Series:
+        if use_nlcd_labels:
+            return codes.map(NLCD_LABELS).fillna(codes.astype(str) + "-unknown")
+        if use_reclass_labels:
+            return codes.map(RECLASS_LABELS).fillna(codes.astype(str) + "-unknown")
+        return codes.astype(str)
+
     exp_df = pd.DataFrame(exp, index=tm.index, columns=tm.columns).round(2)
-    if use_nlcd_labels:
-        exp_df.index = [NLCD_LABELS.get(int(i), f"{i}-unknown") for i in exp_df.index]
-        exp_df.columns = [
-            NLCD_LABELS.get(int(j), f"{j}-unknown") for j in exp_df.columns
-        ]
-    if use_reclass_labels:
-        exp_df.index = [
-            RECLASS_LABELS.get(int(i), f"{i}-unknown") for i in exp_df.index
-        ]
-        exp_df.columns = [
-            RECLASS_LABELS.get(int(j), f"{j}-unknown") for j in exp_df.columns
-        ]
-    row_labels = list(tm.index)
-    col_labels = list(tm.columns)
-    summary_rows = []
-    for i in tm.index:
-        for j in tm.columns:
-            i_pos = row_labels.index(i)
-            j_pos = col_labels.index(j)
-            expected_val = exp[i_pos][j_pos]
-            if use_nlcd_labels:
-                f_label = NLCD_LABELS.get(int(i), f"{i}-unknown")
-                t_label = NLCD_LABELS.get(int(j), f"{j}-unknown")
-            elif use_reclass_labels:
-                f_label = RECLASS_LABELS.get(int(i), f"{i}-unknown")
-                t_label = RECLASS_LABELS.get(int(j), f"{j}-unknown")
-            else:
-                f_label = str(i)
-                t_label = str(j)
-            std_resid = (
-                (tm.loc[i, j] - expected_val) / np.sqrt(expected_val)
-                if expected_val > 0
-                else 0
-            )
-            summary_rows.append(
-                {
-                    "From": int(i),
-                    "To": int(j),
-                    "From_description": f_label,
-                    "To_description": t_label,
-                    "Label": f"{f_label} to {t_label}",
-                    "Observed": round(tm.loc[i, j], 2),
-                    "Expected": round(expected_val, 2),
-                    "StdResid": round(std_resid, 2),
-                    "Significance": "Significant" if abs(std_resid) > 2 else "Not",
-                }
-            )
+    if use_nlcd_labels or use_reclass_labels:
+        exp_df.index = describe(tm.index.to_series()).to_numpy()
+        exp_df.columns = describe(tm.columns.to_series()).to_numpy()
+    n_rows, n_cols = tm.shape
+    from_codes = pd.Series(np.repeat(tm.index.to_numpy(), n_cols))
+    to_codes = pd.Series(np.tile(tm.columns.to_numpy(), n_rows))
+    observed = tm.to_numpy().ravel()
+    expected = exp.ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std_resid = np.where(expected > 0, (observed - expected) / np.sqrt(expected), 0)
+
+    f_label = describe(from_codes)
+    t_label = describe(to_codes)
+    summary = pd.DataFrame(
+        {
+            "From": from_codes.astype(np.int64, copy=False),
+            "To": to_codes.astype(np.int64, copy=False),
+            "From_description": f_label,
+            "To_description": t_label,
+            "Label": f_label.str.cat(t_label, sep=" to "),
+            "Observed": observed,
+            "Expected": np.round(expected, 2),
+            "StdResid": np.round(std_resid, 2),
+            "Significance": np.where(np.abs(std_resid) > 2, "Significant", "Not"),
+        }
+    )
     return {
         "chi2": round(chi2, 4),
         "p": round(p, 6),
-        "summary": pd.DataFrame(summary_rows),
+        "summary": summary,
         "expected": exp_df,
     }
 
 
 def land_change_intensity(tm: pd.DataFrame):
-    M = tm.copy()
-    np.fill_diagonal(M.values, 0)
+    vals = tm.to_numpy(copy=True)
+    np.fill_diagonal(vals, 0)
     total = tm.values.sum()
-    changed = M.values.sum()
-    n = len(M)
+    changed = vals.sum()
+    n = len(tm)
     uniform = round((changed / n) / total * 100, 2) if total > 0 else 0
-    gain = (M.sum(axis=0) / total * 100).round(2) if total > 0 else M.sum(axis=0) * 0
-    loss = (M.sum(axis=1) / total * 100).round(2) if total > 0 else M.sum(axis=1) * 0
+    # Work on the raw arrays and round once; pandas only wraps the results
+    if total > 0:
+        gain = np.round(vals.sum(axis=0) / total * 100, 2)
+        loss = np.round(vals.sum(axis=1) / total * 100, 2)
+        trans_vals = np.round(vals / total * 100, 2)
+    else:
+        gain = vals.sum(axis=0) * 0
+        loss = vals.sum(axis=1) * 0
+        trans_vals = vals * 0
     gain_df = pd.DataFrame(
         {
-            "Class": gain.index,
-            "Gain(%)": gain.values,
+            "Class": tm.columns.to_numpy(),
+            "Gain(%)": gain,
             "Uniform(%)": uniform,
             "Status": np.where(gain > uniform, "Active Gain", "Dormant Gain"),
         }
-    ).round(2)
+    )
     loss_df = pd.DataFrame(
         {
-            "Class": loss.index,
-            "Loss(%)": loss.values,
+            "Class": tm.index.to_numpy(),
+            "Loss(%)": loss,
             "Uniform(%)": uniform,
             "Status": np.where(loss > uniform, "Active Loss", "Dormant Loss"),
         }
-    ).round(2)
-    trans = (M / total * 100).round(2) if total > 0 else M * 0
-    trans_flat = trans.reset_index().melt(
-        id_vars=trans.index.name or "index", var_name="To", value_name="Intensity(%)"
-    )
-    trans_flat = trans_flat.rename(columns={trans.index.name or "index": "From"})
-    trans_flat = (
-        trans_flat[trans_flat["Intensity(%)"] > 0]
-        .sort_values("Intensity(%)", ascending=False)
-        .reset_index(drop=True)
     )
+    trans = pd.DataFrame(trans_vals, index=tm.index, columns=tm.columns)
+    trans_flat = ranked_transitions(trans, "From", "Intensity(%)")
     return gain_df, loss_df, trans_flat
 
 
+def excel_values(values) -> np.ndarray:
+    # Python scalars for xlsxwriter; NaN becomes None, which writes nothing
+    out = np.asarray(values, dtype=object)
+    out[pd.isna(out)] = None
+    return out
+
+
+def write_frame(worksheet, df, startrow, keep_index, header_format):
+    """Write df row by row, bypassing pandas' per-cell ExcelFormatter."""
+    # Strictly row-major, as xlsxwriter's constant_memory mode requires
+    startcol = 1 if keep_index else 0
+    if keep_index:
+        worksheet.write(startrow, 0, df.index.name, header_format)
+    worksheet.write_row(
+        startrow, startcol, excel_values(df.columns.tolist()), header_format
+    )
+    if df.empty:
+        return
+    body = np.column_stack(
+        [excel_values(df.iloc[:, j].tolist()) for j in range(df.shape[1])]
+    )
+    index_values = excel_values(df.index.tolist()) if keep_index else None
+    for i, row in enumerate(body.tolist()):
+        if keep_index:
+            worksheet.write(startrow + 1 + i, 0, index_values[i], header_format)
+        worksheet.write_row(startrow + 1 + i, startcol, row)
+
+
 def write_excel_with_title(
     writer, df, sheet_name, title_text, keep_index=False, description_text=None
 ):
-    df.to_excel(writer, sheet_name=sheet_name, startrow=2, index=keep_index)
-    worksheet = writer.sheets[sheet_name]
     workbook = writer.book
+    worksheet = workbook.add_worksheet(sheet_name)
     last_col = max(df.shape[1] - 1 + (1 if keep_index else 0), 0)  # Fix for empty dfs
+    header_format = workbook.add_format(
+        {"bold": True, "border": 1, "align": "center", "valign": "top"}
+    )
     title_format = workbook.add_format(
         {"bold": True, "align": "center", "valign": "vcenter", "font_size": 14}
     )
     desc_format = workbook.add_format(
         {"text_wrap": True, "italic": True, "align": "left", "valign": "top"}
     )
+    # Title first, then the table, then the description: rows go out in order
     worksheet.merge_range(0, 0, 0, last_col, title_text, title_format)
+    write_frame(worksheet, df, 2, keep_index, header_format)
     if description_text:
         desc_row = 2 + len(df) + 2
         worksheet.merge_range(
@@ -404,9 +820,68 @@ def write_excel_with_title(
         )
 
 
-def safe_label(map_dict, code):
-    code_str = str(code)
-    return map_dict.get(code_str, f"{code_str}-empty")
+class _ZipChunkSink(io.RawIOBase):
+    # Unseekable, so ZipFile writes data descriptors and never seeks back
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def scan_zip_entries(results_dir: str, skipped=frozenset()) -> List[tuple]:
+    # (path, arcname, stat) per file; scandir hands back the stat it already
+    # has, so nothing is re-stat'ed when the archive is built
+    entries = []
+    stack = [results_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.path not in skipped:
+                    arcname = os.path.relpath(entry.path, results_dir)
+                    entries.append((entry.path, arcname, entry.stat()))
+    return entries
+
+
+def iter_zip(entries: List[tuple]):
+    """
+    Build the result ZIP on the fly, yielding each member's bytes as soon as
+    it is compressed, so the archive is never held whole on disk or in RAM.
+    """
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for file_path, arcname, st in entries:
+            if file_path.endswith(PRECOMPRESSED_SUFFIXES):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            if st.st_size < ZIP_SMALL_FILE_BYTES:
+                # One read and one compress call instead of 8 KB chunks
+                zinfo = zipfile.ZipInfo(
+                    arcname, datetime.fromtimestamp(st.st_mtime).timetuple()[:6]
+                )
+                zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+                zinfo.compress_type = compress_type
+                with open(file_path, "rb") as f:
+                    zf.writestr(zinfo, f.read(), compresslevel=3)
+            else:
+                zf.write(
+                    file_path, arcname, compress_type=compress_type, compresslevel=3
+                )
+            yield sink.drain()
+    # Central directory, written when the archive is closed
+    yield sink.drain()
 
 
 # ------------------------------------------------------------------
@@ -462,8 +937,6 @@ def export_vegetation_structure(tif_path, out_csv_path):
     with rasterio.open(tif_path) as src:
         arr = src.read(1)
         nodata = src.nodata
-        if nodata is not None:
-            arr = np.where(arr == nodata, np.nan, arr)
 
     # ============================================================
     # PIXEL COUNTS
@@ -473,11 +946,18 @@ def export_vegetation_structure(tif_path, out_csv_path):
     shrub_codes = [51, 52]
     herb_codes = [71, 72, 81, 82, 90, 95]
 
-    total_pixels = np.count_nonzero(~np.isnan(arr))
-    total_veg_pixels = np.count_nonzero(~np.isin(arr, non_veg_codes) & ~np.isnan(arr))
-    woody_pixels = np.count_nonzero(np.isin(arr, woody_codes) & ~np.isnan(arr))
-    shrub_pixels = np.count_nonzero(np.isin(arr, shrub_codes) & ~np.isnan(arr))
-    herb_pixels = np.count_nonzero(np.isin(arr, herb_codes) & ~np.isnan(arr))
+    # One histogram over the integer codes replaces a float copy of the band
+    # plus a masked isin pass per code group; nodata pixels are dropped here
+    code_counts = np.bincount(arr.ravel(), minlength=256)
+    if nodata is not None and float(nodata).is_integer():
+        if 0 <= nodata < len(code_counts):
+            code_counts[int(nodata)] = 0
+
+    total_pixels = int(code_counts.sum())
+    total_veg_pixels = total_pixels - int(code_counts[non_veg_codes].sum())
+    woody_pixels = int(code_counts[woody_codes].sum())
+    shrub_pixels = int(code_counts[shrub_codes].sum())
+    herb_pixels = int(code_counts[herb_codes].sum())
 
     # ============================================================
     # COVER %
@@ -641,74 +1121,193 @@ def export_vegetation_structure(tif_path, out_csv_path):
 # ============================================================
 # === FRAGSTATS LOGIC ========================================
 # ============================================================
-def run_fragstats_routine(tif_path_1, tif_path_2, results_dir):
+@lru_cache(maxsize=None)
+def r_packages():
     """
-    Executes the R-based Fragstats analysis.
+    Loads landscapemetrics and raster through rpy2 on first use. rpy2 can be
+    installed without a working R, so import or R start-up errors return
+    None (once per process) and the caller falls back to pylandstats.
     """
-    if not HAS_RPY2:
-        print("Skipping Fragstats: rpy2 not available.")
-        return
-
     print("Initializing R for Fragstats analysis...")
-    # Activate Pandas conversion
     try:
-        # pandas2ri.activate()
-        landscapemetrics = importr("landscapemetrics")
-        raster_pkg = importr("raster")
-        base = importr("base")
-        # Helper for reclass matrix
-        r_matrix = ro.r["matrix"]
-        calculate_lsm = landscapemetrics.calculate_lsm
-        reclassify_r = raster_pkg.reclassify
+        from rpy2.robjects.packages import importr
+
+        return importr("landscapemetrics"), importr("raster")
     except Exception as e:
-        print(f"Error loading R packages: {e}")
-        return
+        print(f"WARNING: R landscapemetrics unavailable: {e}")
+        return None
 
-    try:
-        # Load Rasters
-        print("Loading rasters into R...")
-        r2010 = raster_pkg.raster(tif_path_1)
-        r2024 = raster_pkg.raster(tif_path_2)
 
-        # Metrics Definitions
-        class_metrics = StrVector(
-            [
-                "lsm_c_ca",
-                "lsm_c_pland",
-                "lsm_c_pd",
-                "lsm_c_lpi",
-                "lsm_c_ed",
-                "lsm_c_shape_mn",
-                "lsm_c_ai",
-                "lsm_c_cohesion",
-            ]
-        )
-        landscape_metrics = StrVector(
-            [
-                "lsm_l_np",
-                "lsm_l_pd",
-                "lsm_l_shdi",
-                "lsm_l_siei",
-                "lsm_l_contag",
-                "lsm_l_split",
-                "lsm_l_iji",
-                "lsm_l_ai",
-                "lsm_l_pr",
-            ]
-        )
+def lsm_frames_r(tif_path_1, tif_path_2):
+    """
+    Computes the landscapemetrics tables for both years, original and
+    reclassified, through rpy2.
+    """
+    from rpy2.robjects import StrVector, numpy2ri, pandas2ri
 
-        # --- 1. Original Metrics ---
-        print("Calculating Original Metrics...")
-        class2010_r = calculate_lsm(r2010, what=class_metrics)
-        class2024_r = calculate_lsm(r2024, what=class_metrics)
-        land2010_r = calculate_lsm(r2010, what=landscape_metrics)
-        land2024_r = calculate_lsm(r2024, what=landscape_metrics)
+    # Activate Pandas conversion
+    # pandas2ri.activate()
+    landscapemetrics, raster_pkg = r_packages()
+    calculate_lsm = landscapemetrics.calculate_lsm
+    reclassify_r = raster_pkg.reclassify
+
+    # Load Rasters
+    print("Loading rasters into R...")
+    r2010 = raster_pkg.raster(tif_path_1)
+    r2024 = raster_pkg.raster(tif_path_2)
+
+    # Metrics Definitions
+    class_metrics = StrVector(
+        [
+            "lsm_c_ca",
+            "lsm_c_pland",
+            "lsm_c_pd",
+            "lsm_c_lpi",
+            "lsm_c_ed",
+            "lsm_c_shape_mn",
+            "lsm_c_ai",
+            "lsm_c_cohesion",
+        ]
+    )
+    landscape_metrics = StrVector(
+        [
+            "lsm_l_np",
+            "lsm_l_pd",
+            "lsm_l_shdi",
+            "lsm_l_siei",
+            "lsm_l_contag",
+            "lsm_l_split",
+            "lsm_l_iji",
+            "lsm_l_ai",
+            "lsm_l_pr",
+        ]
+    )
+
+    # --- 1. Original Metrics ---
+    print("Calculating Original Metrics...")
+    class2010_r = calculate_lsm(r2010, what=class_metrics)
+    class2024_r = calculate_lsm(r2024, what=class_metrics)
+    land2010_r = calculate_lsm(r2010, what=landscape_metrics)
+    land2024_r = calculate_lsm(r2024, what=landscape_metrics)
+
+    # Convert to Pandas
+    class2010 = pandas2ri.rpy2py(class2010_r)
+    class2024 = pandas2ri.rpy2py(class2024_r)
+    land2010 = pandas2ri.rpy2py(land2010_r)
+    land2024 = pandas2ri.rpy2py(land2024_r)
+
+    # --- 2. Reclassification ---
+    print("Reclassifying Rasters in R...")
+    # is/becomes pairs as a 20x2 int32 array; numpy2ri converts it to an R
+    # matrix in one bulk copy instead of element-wise through IntVector
+    reclass_pairs = np.array(list(RECLASS_DICT.items()), dtype=np.int32)
+    reclass_mat = numpy2ri.numpy2rpy(reclass_pairs)
+    r2010_re = reclassify_r(r2010, reclass_mat)
+    r2024_re = reclassify_r(r2024, reclass_mat)
+
+    # --- 3. Reclass Metrics ---
+    print("Calculating Reclassified Metrics...")
+    class2010_re_r = calculate_lsm(r2010_re, what=class_metrics)
+    class2024_re_r = calculate_lsm(r2024_re, what=class_metrics)
+    land2010_re_r = calculate_lsm(r2010_re, what=landscape_metrics)
+    land2024_re_r = calculate_lsm(r2024_re, what=landscape_metrics)
+
+    class2010_re = pandas2ri.rpy2py(class2010_re_r)
+    class2024_re = pandas2ri.rpy2py(class2024_re_r)
+    land2010_re = pandas2ri.rpy2py(land2010_re_r)
+    land2024_re = pandas2ri.rpy2py(land2024_re_r)
+
+    return (
+        class2010,
+        class2024,
+        land2010,
+        land2024,
+        class2010_re,
+        class2024_re,
+        land2010_re,
+        land2024_re,
+    )
 
-        # Convert to Pandas
-        class2010 = pandas2ri.rpy2py(class2010_r)
-        class2024 = pandas2ri.rpy2py(class2024_r)
-        land2010 = pandas2ri.rpy2py(land2010_r)
-        land2024 = pandas2ri.rpy2py(land2024_r)
+
+def lsm_frames_pylandstats(tif_path_1, tif_path_2):
+    """
+    Computes the same tables as lsm_frames_r with pylandstats, for hosts
+    without R. Metrics pylandstats does not implement are left out.
+    """
+    import pylandstats as pls
+
+    # R's reclassify keeps codes missing from the matrix, unlike reclassify()
+    passthrough_lut = np.arange(256, dtype=np.uint8)
+    passthrough_lut[_RECLASS_KEYS] = _RECLASS_VALS
+
+    frames = []
+    for reclassified in (False, True):
+        for tif_path in (tif_path_1, tif_path_2):
+            with rasterio.open(tif_path) as src:
+                arr = src.read(1)
+                res = (abs(src.transform.a), abs(src.transform.e))
+                nodata = src.nodata
+            if reclassified:
+                arr = np.take(passthrough_lut, arr)
+            # As with raster() in R, only the file's nodata (250) is excluded;
+            # the 0 outside the AOI is counted as a class of its own
+            landscape = pls.Landscape(arr, res=res, nodata=nodata)
+            frames.append(pylandstats_long_frames(landscape))
+    (c1, l1), (c2, l2), (c1_re, l1_re), (c2_re, l2_re) = frames
+    return c1, c2, l1, l2, c1_re, c2_re, l1_re, l2_re
+
+
+def pylandstats_long_frames(landscape):
+    # Reshape to landscapemetrics' long layout: layer, level, class, id, metric, value
+    class_wide = landscape.compute_class_metrics_df(
+        metrics=list(PLS_CLASS_METRICS)
+    ).rename(columns=PLS_CLASS_METRICS)
+    class_long = class_wide.rename_axis("class").reset_index()
+    class_long = class_long.melt(id_vars="class", var_name="metric")
+    class_long.insert(0, "layer", 1)
+    class_long.insert(1, "level", "class")
+    class_long.insert(3, "id", np.nan)
+
+    land_wide = landscape.compute_landscape_metrics_df(
+        metrics=list(PLS_LANDSCAPE_METRICS)
+    ).rename(columns=PLS_LANDSCAPE_METRICS)
+    land_wide["pr"] = len(landscape.classes)
+    land_long = land_wide.melt(var_name="metric")
+    land_long.insert(0, "layer", 1)
+    land_long.insert(1, "level", "landscape")
+    land_long.insert(2, "class", np.nan)
+    land_long.insert(3, "id", np.nan)
+    return class_long, land_long
+
+
+def run_fragstats_routine(
+    tif_path_1, tif_path_2, results_dir, include_xlsx=True, include_csv=True
+):
+    """
+    Executes the Fragstats analysis (R landscapemetrics, or pylandstats
+    when rpy2 is unavailable). Returns the status for the metadata file,
+    naming the backend that ran.
+    """
+    if HAS_RPY2 and r_packages() is not None:
+        backend, compute_frames = "landscapemetrics via rpy2", lsm_frames_r
+    elif HAS_PYLANDSTATS:
+        print("R not available, computing Fragstats metrics with pylandstats.")
+        backend, compute_frames = "pylandstats", lsm_frames_pylandstats
+    else:
+        print("Skipping Fragstats: neither R nor pylandstats available.")
+        return "Skipped (neither rpy2/R nor pylandstats available)"
+
+    try:
+        (
+            class2010,
+            class2024,
+            land2010,
+            land2024,
+            class2010_re,
+            class2024_re,
+            land2010_re,
+            land2024_re,
+        ) = compute_frames(tif_path_1, tif_path_2)
 
         # Merge & Diff (Class Original)
         class2024_ren = class2024.rename(columns={"value": "value_year2"})
@@ -738,66 +1337,6 @@ def run_fragstats_routine(tif_path_1, tif_path_2, results_dir):
             compare_land_orig["value_year2"] - compare_land_orig["value_year1"]
         )
 
-        # --- 2. Reclassification ---
-        print("Reclassifying Rasters in R...")
-        reclass_values = [
-            11,
-            1,
-            12,
-            1,
-            21,
-            2,
-            22,
-            2,
-            23,
-            2,
-            24,
-            2,
-            41,
-            3,
-            42,
-            3,
-            43,
-            3,
-            51,
-            4,
-            52,
-            4,
-            71,
-            5,
-            72,
-            5,
-            81,
-            5,
-            82,
-            5,
-            90,
-            5,
-            95,
-            5,
-            73,
-            6,
-            74,
-            6,
-            31,
-            7,
-        ]
-        reclass_mat = r_matrix(IntVector(reclass_values), ncol=2, byrow=True)
-        r2010_re = reclassify_r(r2010, reclass_mat)
-        r2024_re = reclassify_r(r2024, reclass_mat)
-
-        # --- 3. Reclass Metrics ---
-        print("Calculating Reclassified Metrics...")
-        class2010_re_r = calculate_lsm(r2010_re, what=class_metrics)
-        class2024_re_r = calculate_lsm(r2024_re, what=class_metrics)
-        land2010_re_r = calculate_lsm(r2010_re, what=landscape_metrics)
-        land2024_re_r = calculate_lsm(r2024_re, what=landscape_metrics)
-
-        class2010_re = pandas2ri.rpy2py(class2010_re_r)
-        class2024_re = pandas2ri.rpy2py(class2024_re_r)
-        land2010_re = pandas2ri.rpy2py(land2010_re_r)
-        land2024_re = pandas2ri.rpy2py(land2024_re_r)
-
         # Merge & Diff (Class Reclass)
         class2024_re_ren = class2024_re.rename(columns={"value": "value_year2"})
         class2010_re_ren = class2010_re.rename(columns={"value": "value_year1"})
@@ -813,17 +1352,8 @@ def run_fragstats_routine(tif_path_1, tif_path_2, results_dir):
         )
 
         # Map Labels
-        class_label_map = {
-            "1": "Water",
-            "2": "Developed",
-            "3": "Forest",
-            "4": "Shrub",
-            "5": "Herbaceous",
-            "6": "Nonvascular",
-            "7": "Sparse vegetation",
-        }
         compare_class_re["class_label"] = (
-            compare_class_re["class"].astype(str).map(class_label_map)
+            compare_class_re["class"].astype(str).map(FRAGSTATS_CLASS_LABELS)
         )
         compare_class_re = compare_class_re[compare_class_re["class"].isin(range(1, 8))]
 
@@ -853,281 +1383,502 @@ def run_fragstats_routine(tif_path_1, tif_path_2, results_dir):
         desc_text = "It shows the fragstats results for two years and changes."
 
         # SAVE EXCEL: Class Level
-        with pd.ExcelWriter(class_excel, engine="xlsxwriter") as writer:
-            write_excel_with_title(
-                writer, compare_class_orig, "Original", title_class, False, desc_text
-            )
-            write_excel_with_title(
-                writer, compare_class_re, "Reclassified", title_class, False, desc_text
-            )
+        if include_xlsx:
+            with pd.ExcelWriter(
+                class_excel, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+            ) as writer:
+                write_excel_with_title(
+                    writer,
+                    compare_class_orig,
+                    "Original",
+                    title_class,
+                    False,
+                    desc_text,
+                )
+                write_excel_with_title(
+                    writer,
+                    compare_class_re,
+                    "Reclassified",
+                    title_class,
+                    False,
+                    desc_text,
+                )
 
         # SAVE EXCEL: Landscape Level
-        with pd.ExcelWriter(land_excel, engine="xlsxwriter") as writer:
-            write_excel_with_title(
-                writer, compare_land_orig, "Original", title_land, False, desc_text
-            )
-            write_excel_with_title(
-                writer, compare_land_re, "Reclassified", title_land, False, desc_text
-            )
+        if include_xlsx:
+            with pd.ExcelWriter(
+                land_excel, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+            ) as writer:
+                write_excel_with_title(
+                    writer, compare_land_orig, "Original", title_land, False, desc_text
+                )
+                write_excel_with_title(
+                    writer,
+                    compare_land_re,
+                    "Reclassified",
+                    title_land,
+                    False,
+                    desc_text,
+                )
 
         # SAVE CSVs (User Request)
-        compare_class_orig.to_csv(
-            os.path.join(results_dir, "FRAGSTATS_Class_Original.csv"), index=False
-        )
-        compare_class_re.to_csv(
-            os.path.join(results_dir, "FRAGSTATS_Class_Reclassified.csv"), index=False
-        )
-        compare_land_orig.to_csv(
-            os.path.join(results_dir, "FRAGSTATS_Landscape_Original.csv"), index=False
-        )
-        compare_land_re.to_csv(
-            os.path.join(results_dir, "FRAGSTATS_Landscape_Reclassified.csv"),
-            index=False,
-        )
+        if include_csv:
+            compare_class_orig.to_csv(
+                os.path.join(results_dir, "FRAGSTATS_Class_Original.csv"), index=False
+            )
+            compare_class_re.to_csv(
+                os.path.join(results_dir, "FRAGSTATS_Class_Reclassified.csv"),
+                index=False,
+            )
+            compare_land_orig.to_csv(
+                os.path.join(results_dir, "FRAGSTATS_Landscape_Original.csv"),
+                index=False,
+            )
+            compare_land_re.to_csv(
+                os.path.join(results_dir, "FRAGSTATS_Landscape_Reclassified.csv"),
+                index=False,
+            )
 
         print("Fragstats analysis completed successfully.")
+        return f"Success ({backend})"
     except Exception as e:
         print(f"Error during Fragstats execution: {e}")
         import traceback
 
         traceback.print_exc()
+        return f"Failed ({backend}): {e}"
 
 
 # ============================================================
-# === MAIN ENDPOINT ==========================================
+# === ANALYSIS PIPELINE ======================================
 # ============================================================
-@app.post("/api/analyze")
-async def analyze(request: AnalysisRequest):
-    try:
-        output_dir = tempfile.mkdtemp(prefix="nlcd_analysis_")
-        results_dir = os.path.join(output_dir, "results")
-        os.makedirs(results_dir, exist_ok=True)
+def crop_cache_path(tif_path: str, aoi: AOIContext, geom_key: str) -> str:
+    # The raster's mtime invalidates entries when a year's file is replaced;
+    # the window/transform pin the grid the AOI was rasterized on
+    st = os.stat(tif_path)
+    h = hashlib.sha256(f"{CROP_CACHE_VERSION}|{geom_key}".encode())
+    h.update(
+        f"|{os.path.abspath(tif_path)}|{st.st_mtime_ns}"
+        f"|{aoi.window}|{tuple(aoi.transform)}".encode()
+    )
+    return os.path.join(CROP_CACHE_DIR, h.hexdigest() + ".npy")
 
-        geojson_data = request.geojson
-        year1 = request.year1
-        year2 = request.year2
-        print(f"Starting analysis for years {year1} to {year2}")
 
-        # --- LOAD GEOMETRY ---
-        if geojson_data.get("type") == "Feature":
-            gdf = gpd.GeoDataFrame.from_features([geojson_data])
-        elif geojson_data.get("type") == "FeatureCollection":
-            gdf = gpd.GeoDataFrame.from_features(geojson_data.get("features", []))
-        elif geojson_data.get("type") in ["Polygon", "MultiPolygon"]:
-            from shapely.geometry import shape
+def read_crop(tif_path: str, aoi: AOIContext, geom_key: Optional[str] = None):
+    """
+    Crop one year's NLCD raster to the AOI. Each call opens its own dataset,
+    so the two years can be read on separate threads. With a geom_key the
+    cropped band is served from / saved to the on-disk crop cache.
+    """
+    if CROP_CACHE_MAX_BYTES <= 0:
+        geom_key = None
+    if geom_key is not None:
+        cache_path = crop_cache_path(tif_path, aoi, geom_key)
+        try:
+            band = np.load(cache_path)
+            # Refresh the mtime so pruning evicts least recently used first
+            os.utime(cache_path)
+            # Cache hit: the profile comes from the cached grid, so the
+            # dataset is not opened at all
+            return band, cropped_meta(raster_grid(tif_path).meta, aoi)
+        except (OSError, ValueError):
+            # Missing, pruned meanwhile, or unreadable: crop from the source
+            pass
 
-            gdf = gpd.GeoDataFrame(geometry=[shape(geojson_data)])
-        else:
-            raise HTTPException(status_code=400, detail="Invalid GeoJSON format")
+    with rasterio.open(tif_path) as src:
+        band, meta = crop_raster_in_memory(src, aoi)
+    if geom_key is None or band.nbytes > CROP_CACHE_MAX_BYTES:
+        return band, meta
 
-        if gdf.empty:
-            raise HTTPException(
-                status_code=400, detail="GeoJSON contains no valid geometries"
-            )
+    # Write to a temp name and rename, so concurrent requests never read a
+    # partial file; a failed write only costs the cache entry
+    tmp_path = None
+    try:
+        os.makedirs(CROP_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CROP_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, band)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not cache cropped raster: {e}")
+        # Most likely a full disk: don't leave the partial file behind
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+    prune_crop_cache()
+    return band, meta
+
+
+def prune_crop_cache(max_bytes: Optional[int] = None):
+    """
+    Delete the least recently used crop cache entries beyond max_bytes, and
+    temp files orphaned by a process that died mid-write.
+    """
+    if max_bytes is None:
+        max_bytes = CROP_CACHE_MAX_BYTES
+    stale_before = time.time_ns() - CROP_CACHE_TMP_MAX_AGE_S * 10**9
+    entries = []
+    try:
+        with os.scandir(CROP_CACHE_DIR) as it:
+            for entry in it:
+                is_tmp = entry.name.endswith(".tmp")
+                if not is_tmp and not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # Removed by a concurrent prune
+                    continue
+                if is_tmp:
+                    # Younger temp files may still be in the middle of a write
+                    if st.st_mtime_ns < stale_before:
+                        with contextlib.suppress(OSError):
+                            os.unlink(entry.path)
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        total -= size
+
+
+# Change maps are CPU-bound in Agg and PNG encoding and hold the GIL, so on
+# multi-core hosts they are rendered in worker processes. The pool is
+# created on first use and shared by all requests.
+PLOT_WORKERS = min(7, os.cpu_count() or 1)
+
+
+@lru_cache(maxsize=None)
+def _plot_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: the parent holds GDAL, Numba and event-loop threads
+    pool = ProcessPoolExecutor(
+        max_workers=PLOT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    atexit.register(pool.shutdown, cancel_futures=True)
+    return pool
 
-        try:
-            tif_path_year1 = get_tif_path(year1)
-            tif_path_year2 = get_tif_path(year2)
-        except FileNotFoundError as e:
-            raise HTTPException(status_code=404, detail=str(e))
 
-        with rasterio.open(tif_path_year2) as src_temp:
-            raster_crs = src_temp.crs
+def share_array(arr: np.ndarray):
+    # Copy arr into a shared memory block once; workers map it by name
+    # instead of unpickling their own copy with every job
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
 
-        if gdf.crs is None:
-            gdf = gdf.set_crs("EPSG:4326")
-        if gdf.crs != raster_crs:
-            gdf = gdf.to_crs(raster_crs)
 
-        geoms = [geom for geom in gdf.geometry if geom is not None]
-        if not geoms:
-            raise HTTPException(status_code=400, detail="No valid geometries found")
+def attach_array(spec):
+    # The view must be dropped before shm.close()
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
 
-        # --- CROP RASTERS ---
-        year1_data, meta_year1 = crop_raster_in_memory(tif_path_year1, geoms)
-        year2_data, meta_year2 = crop_raster_in_memory(tif_path_year2, geoms)
 
-        out_tif_year1 = os.path.join(results_dir, f"crop_year1_{year1}.tif")
-        out_tif_year2 = os.path.join(results_dir, f"crop_year2_{year2}.tif")
+@lru_cache(maxsize=1)
+def _shared_basemap_image(spec) -> np.ndarray:
+    # One private copy per worker and request; later jobs reuse it
+    shm, view = attach_array(spec)
+    img = view.copy()
+    del view
+    shm.close()
+    return img
 
-        meta_y1 = meta_year1.copy()
-        meta_y1.update({"driver": "GTiff", "count": 1})
-        with rasterio.open(out_tif_year1, "w", **meta_y1) as dst:
-            dst.write(year1_data[0], 1)
 
-        meta_y2 = meta_year2.copy()
-        meta_y2.update({"driver": "GTiff", "count": 1})
-        with rasterio.open(out_tif_year2, "w", **meta_y2) as dst:
-            dst.write(year2_data[0], 1)
+@lru_cache(maxsize=8)
+def fetch_basemap(left: float, bottom: float, right: float, top: float):
+    """
+    OSM tiles for a Web Mercator extent as (image, extent, attribution).
+    Cached, so a repeated AOI reuses the tiles instead of downloading again.
+    """
+    import contextily as ctx
+
+    source = ctx.providers.OpenStreetMap.Mapnik
+    img, extent = ctx.bounds2img(left, bottom, right, top, source=source)
+    return img, extent, source.get("attribution")
+
+
+@lru_cache(maxsize=None)
+def _change_map_style():
+    # Colormap, norm and legend proxy patches, built once per process; the
+    # legend copies the proxies' style, so they can be shared by every map
+    from matplotlib.patches import Rectangle
+
+    _, mcolors = _pyplot()
+    cmap_list = [(0, 0, 0, 0)]
+    for i in range(1, 8):
+        cmap_list.append(mcolors.to_rgba(CLASS_COLORS[i]))
+    cmap = mcolors.ListedColormap(cmap_list)
+    norm = mcolors.BoundaryNorm(range(0, 9), cmap.N)
+    legend_handles = {
+        v: Rectangle((0, 0), 1, 1, color=CLASS_COLORS[v]) for v in range(1, 8)
+    }
+    return cmap, norm, legend_handles
 
-        year1_band = year1_data[0]
-        year2_band = year2_data[0]
 
-        # ============================================================
-        # === FRAGSTATS STEP (INTEGRATED) ============================
-        # ============================================================
-        # We pass the paths to the cropped TIFs we just saved
-        run_fragstats_routine(out_tif_year1, out_tif_year2, results_dir)
+def render_change_map(arr_3857, extent, basemap, title, out_path):
+    """
+    Draw one "what changed into this class" map (Web Mercator raster of the
+    previous classes) and save it as PNG. Uses a standalone Figure rather
+    than pyplot, so it is safe in worker processes and threads alike.
+    """
+    from matplotlib.figure import Figure
+
+    cmap, norm, class_handles = _change_map_style()
+    left, right, bottom, top = extent
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.set_xlim(left, right)
+    ax.set_ylim(bottom, top)
+
+    # Add Basemap (OpenStreetMap via Contextily)
+    if basemap is not None:
+        basemap_img, basemap_extent, attribution = basemap
+        ax.imshow(basemap_img, extent=basemap_extent, interpolation="bilinear")
+        if attribution:
+            import contextily as ctx
+
+            ctx.add_attribution(ax, attribution)
+
+    # Plot the reprojected raster
+    ax.imshow(
+        arr_3857,
+        cmap=cmap,
+        norm=norm,
+        extent=[left, right, bottom, top],
+        interpolation="nearest",
+        alpha=0.8,  # Slight alpha to see map underneath if needed
+    )
 
-        # ============================================================
-        # === TRANSITION MATRIX STEP =================================
-        # ============================================================
-        year1_flat = year1_band.flatten()
-        year2_flat = year2_band.flatten()
+    # Legends & Titles
+    # Classes present (excluding 0) from one bincount pass, no boxing
+    class_counts = np.bincount(arr_3857.ravel(), minlength=8)
+    unique_vals = (np.flatnonzero(class_counts[1:]) + 1).tolist()
+    legend_handles = [class_handles[v] for v in unique_vals]
+    if legend_handles:
+        ax.legend(
+            legend_handles,
+            [LC_NAMES.get(v, str(v)) for v in unique_vals],
+            title="Land Class Before Transition",
+            loc="lower left",
+            bbox_to_anchor=(1.02, 0.1),
+        )
 
-        mask_valid = (~np.isnan(year1_flat)) & (~np.isnan(year2_flat))
-        year1_flat = year1_flat[mask_valid].astype(int)
-        year2_flat = year2_flat[mask_valid].astype(int)
+    ax.set_title(title, fontsize=16)
+    ax.axis("off")
+    fig.savefig(out_path)
 
-        df = pd.DataFrame({"year1": year1_flat, "year2": year2_flat})
-        transition_matrix = pd.crosstab(df["year1"], df["year2"]).round(2)
-        transition_percent = (
-            transition_matrix.div(transition_matrix.sum(axis=1), axis=0) * 100
-        ).round(2)
 
-        transition_matrix_lbl = apply_labels(transition_matrix, NLCD_LABELS)
-        transition_percent_lbl = apply_labels(transition_percent, NLCD_LABELS)
+def render_change_map_shared(
+    target, from_spec, to_spec, extent, basemap, title, out_path
+):
+    """
+    render_change_map in a pool worker: the Mercator rasters and basemap
+    tiles are read from shared memory, so a job only pickles their names.
+    """
+    from_shm, from_3857 = attach_array(from_spec)
+    to_shm, changed_to_3857 = attach_array(to_spec)
+    arr_3857 = np.where(changed_to_3857 == target, from_3857, np.uint8(0))
+    del from_3857, changed_to_3857
+    from_shm.close()
+    to_shm.close()
+    if basemap is not None:
+        img_spec, basemap_extent, attribution = basemap
+        basemap = (_shared_basemap_image(img_spec), basemap_extent, attribution)
+    render_change_map(arr_3857, extent, basemap, title, out_path)
+
+
+def write_crop_tif(path: str, band: np.ndarray, meta: dict):
+    profile = meta.copy()
+    profile.update(CROP_TIFF_PROFILE)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(band, 1)
+
+
+def run_analysis(
+    output_dir: str,
+    geojson_data: dict,
+    year1: int,
+    year2: int,
+    crop_year1: tuple,
+    crop_year2: tuple,
+    include_cropped_rasters: bool = True,
+    include_xlsx: bool = True,
+    include_csv: bool = True,
+) -> List[tuple]:
+    """
+    Blocking part of /api/analyze: writes every table, figure and raster for
+    the cropped years into output_dir/results and returns the
+    (file_path, arcname) entries for the result ZIP.
+    """
+    results_dir = os.path.join(output_dir, "results")
+    year1_band, meta_year1 = crop_year1
+    year2_band, meta_year2 = crop_year2
+
+    out_tif_year1 = os.path.join(results_dir, f"crop_year1_{year1}.tif")
+    out_tif_year2 = os.path.join(results_dir, f"crop_year2_{year2}.tif")
+
+    # Independent files; GDAL compresses with the GIL released
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tif_writes = [
+            pool.submit(write_crop_tif, out_tif_year1, year1_band, meta_year1),
+            pool.submit(write_crop_tif, out_tif_year2, year2_band, meta_year2),
+        ]
+        for future in tif_writes:
+            future.result()
 
-        year1_re = reclassify(year1_band, RECLASS_DICT)
-        year2_re = reclassify(year2_band, RECLASS_DICT)
+    # ============================================================
+    # === FRAGSTATS STEP (INTEGRATED) ============================
+    # ============================================================
+    # We pass the paths to the cropped TIFs we just saved
+    fragstats_status = run_fragstats_routine(
+        out_tif_year1, out_tif_year2, results_dir, include_xlsx, include_csv
+    )
 
-        df_re = pd.DataFrame(
-            {"year1_reclass": year1_re.flatten(), "year2_reclass": year2_re.flatten()}
-        )
-        transition_matrix_reclass = pd.crosstab(
-            df_re["year1_reclass"], df_re["year2_reclass"]
-        ).round(2)
-        transition_percent_reclass = (
-            transition_matrix_reclass.div(transition_matrix_reclass.sum(axis=1), axis=0)
-            * 100
-        ).round(2)
-
-        transition_matrix_reclass_lbl = apply_reclass_labels(
-            transition_matrix_reclass, RECLASS_LABELS
-        )
-        transition_percent_reclass_lbl = apply_reclass_labels(
-            transition_percent_reclass, RECLASS_LABELS
-        )
+    # ============================================================
+    # === TRANSITION MATRIX STEP =================================
+    # ============================================================
+    # The crops are uint8 (no NaN to mask), so one pass over the bands gives
+    # the original histogram and both reclassified rasters
+    counts, year1_re, year2_re = transition_counts_reclass(year1_band, year2_band)
+    transition_matrix = counts_frame(counts)
+    transition_percent = row_percent(transition_matrix)
+
+    transition_matrix_lbl = apply_labels(transition_matrix, NLCD_LABELS)
+    transition_percent_lbl = apply_labels(transition_percent, NLCD_LABELS)
+
+    # Folded from the original histogram, not a second pass over the pixels
+    transition_matrix_reclass = counts_frame(
+        collapse_transition(counts, _RECLASS_LUT, len(RECLASS_LABELS))
+    )
+    transition_percent_reclass = row_percent(transition_matrix_reclass)
 
-        # Long table logic
-        records = []
-        total_pix = df_re.shape[0]
-        for i in range(0, 8):
-            for j in range(0, 8):
-                count = (
-                    transition_matrix_reclass.loc[i, j]
-                    if (
-                        i in transition_matrix_reclass.index
-                        and j in transition_matrix_reclass.columns
-                    )
-                    else 0
-                )
-                pct = (count / total_pix) * 100 if total_pix > 0 else 0
-                label_simple = f"{RECLASS_NAMES.get(i)} to {RECLASS_NAMES.get(j)}"
-                from_desc = RECLASS_LABELS.get(i, f"{i}-empty")
-                to_desc = RECLASS_LABELS.get(j, f"{j}-empty")
-                label_full = f"{from_desc} to {to_desc}"
-                records.append(
-                    [
-                        i,
-                        j,
-                        label_simple,
-                        from_desc,
-                        to_desc,
-                        label_full,
-                        count,
-                        round(pct, 4),
-                    ]
-                )
+    transition_matrix_reclass_lbl = apply_labels(
+        transition_matrix_reclass, RECLASS_LABELS
+    )
+    transition_percent_reclass_lbl = apply_labels(
+        transition_percent_reclass, RECLASS_LABELS
+    )
 
-        df_reclass_long = pd.DataFrame(
-            records,
-            columns=[
-                "From",
-                "To",
-                "Label",
-                "From_description",
-                "To_description",
-                "Label_full",
-                "Count",
-                "Percent",
-            ],
-        )
+    # Long table logic: every (from, to) pair of the 8 reclass codes
+    n_re = len(RECLASS_NAMES)
+    counts_re = transition_matrix_reclass.reindex(
+        index=range(n_re), columns=range(n_re), fill_value=0
+    ).to_numpy()
+    from_codes, to_codes = np.meshgrid(np.arange(n_re), np.arange(n_re), indexing="ij")
+    from_codes = from_codes.ravel()
+    to_codes = to_codes.ravel()
+    counts_long = counts_re.ravel()
+    total_pix = year1_band.size
+    pct_long = (
+        np.round(counts_long / total_pix * 100, 4)
+        if total_pix > 0
+        else np.zeros_like(counts_long)
+    )
+    reclass_names = np.array([RECLASS_NAMES[c] for c in range(n_re)], dtype=object)
+    from_desc = RECLASS_LABEL_ARR[from_codes]
+    to_desc = RECLASS_LABEL_ARR[to_codes]
+    df_reclass_long = pd.DataFrame(
+        {
+            "From": from_codes,
+            "To": to_codes,
+            "Label": reclass_names[from_codes] + " to " + reclass_names[to_codes],
+            "From_description": from_desc,
+            "To_description": to_desc,
+            "Label_full": from_desc + " to " + to_desc,
+            "Count": counts_long,
+            "Percent": pct_long,
+        }
+    )
 
-        # Save Transition Results
+    # Save Transition Results
+    def write_transition_outputs():
         transition_path = os.path.join(results_dir, "NLCD_Transition_Tables.xlsx")
-        transition_matrix_lbl.to_csv(
-            os.path.join(results_dir, "NLCD_Transition_Tables_Original_Counts.csv"),
-            index=True,
-        )
-        transition_percent_lbl.to_csv(
-            os.path.join(results_dir, "NLCD_Transition_Tables_Original_Percent.csv"),
-            index=True,
-        )
-        transition_matrix_reclass_lbl.to_csv(
-            os.path.join(results_dir, "NLCD_Transition_Tables_Reclass_Counts.csv"),
-            index=True,
-        )
-        transition_percent_reclass_lbl.to_csv(
-            os.path.join(results_dir, "NLCD_Transition_Tables_Reclass_Percent.csv"),
-            index=True,
-        )
-        df_reclass_long.to_csv(
-            os.path.join(results_dir, "NLCD_Transition_Tables_Reclass_Transitions.csv"),
-            index=False,
-        )
-
-        with pd.ExcelWriter(transition_path, engine="xlsxwriter") as writer:
-            write_excel_with_title(
-                writer,
-                transition_matrix_lbl,
-                "Original_Counts",
-                "Original NLCD Land Cover Change Transition in Counts",
-                keep_index=True,
+        if include_csv:
+            transition_matrix_lbl.to_csv(
+                os.path.join(results_dir, "NLCD_Transition_Tables_Original_Counts.csv"),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                transition_percent_lbl,
-                "Original_Percent",
-                "Original NLCD Land Cover Change Transition in Percent",
-                keep_index=True,
+            transition_percent_lbl.to_csv(
+                os.path.join(
+                    results_dir, "NLCD_Transition_Tables_Original_Percent.csv"
+                ),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                transition_matrix_reclass_lbl,
-                "Reclass_Counts",
-                "Reclassified Land Cover Change Transition in Counts",
-                keep_index=True,
+            transition_matrix_reclass_lbl.to_csv(
+                os.path.join(results_dir, "NLCD_Transition_Tables_Reclass_Counts.csv"),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                transition_percent_reclass_lbl,
-                "Reclass_Percent",
-                "Reclassified Land Cover Change Transition in Percent",
-                keep_index=True,
+            transition_percent_reclass_lbl.to_csv(
+                os.path.join(results_dir, "NLCD_Transition_Tables_Reclass_Percent.csv"),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                df_reclass_long,
-                "Reclass_Transitions",
-                "Full Reclassified Land Cover Change Transition Table",
-                keep_index=False,
+            df_reclass_long.to_csv(
+                os.path.join(
+                    results_dir, "NLCD_Transition_Tables_Reclass_Transitions.csv"
+                ),
+                index=False,
             )
 
-        # ============================================================
-        # === NORM & RANK / CHI-SQUARE / INTENSITY ===================
-        # ============================================================
-        # (Standard processing as per original script)
-        # Norm/Rank
-        norm_orig, rank_orig = normalize_and_rank(
-            transition_matrix, label="Original", use_nlcd_labels=True
-        )
-        norm_re, rank_re = normalize_and_rank(
-            transition_matrix_reclass, label="Reclassified", use_reclass_labels=True
-        )
+        if include_xlsx:
+            with pd.ExcelWriter(
+                transition_path, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+            ) as writer:
+                write_excel_with_title(
+                    writer,
+                    transition_matrix_lbl,
+                    "Original_Counts",
+                    "Original NLCD Land Cover Change Transition in Counts",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    transition_percent_lbl,
+                    "Original_Percent",
+                    "Original NLCD Land Cover Change Transition in Percent",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    transition_matrix_reclass_lbl,
+                    "Reclass_Counts",
+                    "Reclassified Land Cover Change Transition in Counts",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    transition_percent_reclass_lbl,
+                    "Reclass_Percent",
+                    "Reclassified Land Cover Change Transition in Percent",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    df_reclass_long,
+                    "Reclass_Transitions",
+                    "Full Reclassified Land Cover Change Transition Table",
+                    keep_index=False,
+                )
 
+    # ============================================================
+    # === NORM & RANK / CHI-SQUARE / INTENSITY ===================
+    # ============================================================
+    # (Standard processing as per original script)
+    # Norm/Rank
+    norm_orig, rank_orig = normalize_and_rank(
+        transition_matrix, label="Original", use_nlcd_labels=True
+    )
+    norm_re, rank_re = normalize_and_rank(
+        transition_matrix_reclass, label="Reclassified", use_reclass_labels=True
+    )
+
+    def write_normalized_outputs():
         norm_path = os.path.join(results_dir, "NLCD_Normalized_Ranked.xlsx")
-        with pd.ExcelWriter(norm_path, engine="xlsxwriter") as writer:
+        if include_csv:
             if norm_orig is not None:
                 norm_orig.to_csv(
                     os.path.join(
@@ -1141,6 +1892,26 @@ async def analyze(request: AnalysisRequest):
                     ),
                     index=False,
                 )
+            if norm_re is not None:
+                norm_re.to_csv(
+                    os.path.join(
+                        results_dir, "NLCD_Normalized_Ranked_Norm_Reclass.csv"
+                    ),
+                    index=True,
+                )
+                rank_re.to_csv(
+                    os.path.join(
+                        results_dir, "NLCD_Normalized_Ranked_Rank_Reclass.csv"
+                    ),
+                    index=False,
+                )
+
+        if not include_xlsx:
+            return
+        with pd.ExcelWriter(
+            norm_path, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+        ) as writer:
+            if norm_orig is not None:
                 write_excel_with_title(
                     writer,
                     norm_orig,
@@ -1157,18 +1928,6 @@ async def analyze(request: AnalysisRequest):
                 )
 
             if norm_re is not None:
-                norm_re.to_csv(
-                    os.path.join(
-                        results_dir, "NLCD_Normalized_Ranked_Norm_Reclass.csv"
-                    ),
-                    index=True,
-                )
-                rank_re.to_csv(
-                    os.path.join(
-                        results_dir, "NLCD_Normalized_Ranked_Rank_Reclass.csv"
-                    ),
-                    index=False,
-                )
                 write_excel_with_title(
                     writer,
                     norm_re,
@@ -1184,385 +1943,446 @@ async def analyze(request: AnalysisRequest):
                     keep_index=False,
                 )
 
-        # Chi-Square
-        chi_orig = chi_square_summary(transition_matrix, use_nlcd_labels=True)
-        chi_re = chi_square_summary(transition_matrix_reclass, use_reclass_labels=True)
-        summary_re2 = chi_re["summary"].copy()
-        summary_re2["ChiSquare"] = chi_re["chi2"]
-        summary_re2 = summary_re2[
-            [
-                "From",
-                "To",
-                "From_description",
-                "To_description",
-                "Label",
-                "ChiSquare",
-                "Observed",
-                "Expected",
-                "StdResid",
-                "Significance",
-            ]
+    # Chi-Square
+    chi_orig = chi_square_summary(transition_matrix, use_nlcd_labels=True)
+    chi_re = chi_square_summary(transition_matrix_reclass, use_reclass_labels=True)
+    summary_re2 = chi_re["summary"].copy()
+    summary_re2["ChiSquare"] = chi_re["chi2"]
+    summary_re2 = summary_re2[
+        [
+            "From",
+            "To",
+            "From_description",
+            "To_description",
+            "Label",
+            "ChiSquare",
+            "Observed",
+            "Expected",
+            "StdResid",
+            "Significance",
         ]
+    ]
 
+    def write_chi_square_outputs():
         chi_path = os.path.join(results_dir, "NLCD_ChiSquare_Results.xlsx")
-        chi_orig["expected"].to_csv(
-            os.path.join(results_dir, "NLCD_ChiSquare_Results_Expected_Original.csv"),
-            index=True,
-        )
-        chi_orig["summary"].to_csv(
-            os.path.join(results_dir, "NLCD_ChiSquare_Results_Summary_Original.csv"),
-            index=False,
-        )
-        chi_re["expected"].to_csv(
-            os.path.join(results_dir, "NLCD_ChiSquare_Results_Expected_Reclass.csv"),
-            index=True,
-        )
-        chi_re["summary"].to_csv(
-            os.path.join(results_dir, "NLCD_ChiSquare_Results_Summary_Reclass.csv"),
-            index=False,
-        )
-        summary_re2.to_csv(
-            os.path.join(results_dir, "NLCD_ChiSquare_Results_Summary_Reclass_2.csv"),
-            index=False,
-        )
-
-        with pd.ExcelWriter(chi_path, engine="xlsxwriter") as writer:
-            write_excel_with_title(
-                writer,
-                chi_orig["expected"],
-                "Expected_Original",
-                "Expected Transition Matrix (Original)",
-                keep_index=True,
+        if include_csv:
+            chi_orig["expected"].to_csv(
+                os.path.join(
+                    results_dir, "NLCD_ChiSquare_Results_Expected_Original.csv"
+                ),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                chi_orig["summary"],
-                "Summary_Original",
-                "Chi-square Summary (Original)",
-                keep_index=False,
+            chi_orig["summary"].to_csv(
+                os.path.join(
+                    results_dir, "NLCD_ChiSquare_Results_Summary_Original.csv"
+                ),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                chi_re["expected"],
-                "Expected_Reclass",
-                "Expected Transition Matrix (Reclass)",
-                keep_index=True,
+            chi_re["expected"].to_csv(
+                os.path.join(
+                    results_dir, "NLCD_ChiSquare_Results_Expected_Reclass.csv"
+                ),
+                index=True,
             )
-            write_excel_with_title(
-                writer,
-                chi_re["summary"],
-                "Summary_Reclass",
-                "Chi-square Summary (Reclass)",
-                keep_index=False,
+            chi_re["summary"].to_csv(
+                os.path.join(results_dir, "NLCD_ChiSquare_Results_Summary_Reclass.csv"),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                summary_re2,
-                "Summary_Reclass_2",
-                "Chi-square Summary with Global Statistic",
-                keep_index=False,
+            summary_re2.to_csv(
+                os.path.join(
+                    results_dir, "NLCD_ChiSquare_Results_Summary_Reclass_2.csv"
+                ),
+                index=False,
             )
 
-        # Intensity
-        gain_o, loss_o, trans_o = land_change_intensity(transition_matrix)
-        gain_r, loss_r, trans_r = land_change_intensity(transition_matrix_reclass)
-
-        nlcd_label_map_full = {str(k): v for k, v in NLCD_LABELS.items()}
-        reclass_label_map_full = {str(k): v for k, v in RECLASS_LABELS.items()}
-
-        # Helper to apply labels quickly for Intensity tables
-        for df_temp, map_ref in [
-            (gain_o, nlcd_label_map_full),
-            (loss_o, nlcd_label_map_full),
-            (gain_r, reclass_label_map_full),
-            (loss_r, reclass_label_map_full),
-        ]:
-            df_temp["Class_Label"] = (
-                df_temp["Class"].astype(str).apply(lambda v: safe_label(map_ref, v))
-            )
+        if include_xlsx:
+            with pd.ExcelWriter(
+                chi_path, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+            ) as writer:
+                write_excel_with_title(
+                    writer,
+                    chi_orig["expected"],
+                    "Expected_Original",
+                    "Expected Transition Matrix (Original)",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    chi_orig["summary"],
+                    "Summary_Original",
+                    "Chi-square Summary (Original)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    chi_re["expected"],
+                    "Expected_Reclass",
+                    "Expected Transition Matrix (Reclass)",
+                    keep_index=True,
+                )
+                write_excel_with_title(
+                    writer,
+                    chi_re["summary"],
+                    "Summary_Reclass",
+                    "Chi-square Summary (Reclass)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    summary_re2,
+                    "Summary_Reclass_2",
+                    "Chi-square Summary with Global Statistic",
+                    keep_index=False,
+                )
 
-        trans_o["From_description"] = (
-            trans_o["From"]
-            .astype(str)
-            .apply(lambda v: safe_label(nlcd_label_map_full, v))
-        )
-        trans_o["To_description"] = (
-            trans_o["To"]
-            .astype(str)
-            .apply(lambda v: safe_label(nlcd_label_map_full, v))
-        )
-        trans_o["Transition_Label"] = trans_o.apply(
-            lambda r: f"{r['From_description']} to {r['To_description']}", axis=1
-        )
+    # Intensity
+    gain_o, loss_o, trans_o = land_change_intensity(transition_matrix)
+    gain_r, loss_r, trans_r = land_change_intensity(transition_matrix_reclass)
+
+    # Label the intensity tables by gathering from the code-indexed arrays
+    for df_temp, label_arr in [
+        (gain_o, NLCD_LABEL_ARR),
+        (loss_o, NLCD_LABEL_ARR),
+        (gain_r, RECLASS_LABEL_ARR),
+        (loss_r, RECLASS_LABEL_ARR),
+    ]:
+        df_temp["Class_Label"] = label_arr[df_temp["Class"].to_numpy()]
+
+    trans_o["From_description"] = NLCD_LABEL_ARR[trans_o["From"].to_numpy()]
+    trans_o["To_description"] = NLCD_LABEL_ARR[trans_o["To"].to_numpy()]
+    trans_o["Transition_Label"] = (
+        trans_o["From_description"] + " to " + trans_o["To_description"]
+    )
 
-        trans_r["From_description"] = (
-            trans_r["From"]
-            .astype(str)
-            .apply(lambda v: safe_label(reclass_label_map_full, v))
-        )
-        trans_r["To_description"] = (
-            trans_r["To"]
-            .astype(str)
-            .apply(lambda v: safe_label(reclass_label_map_full, v))
-        )
-        trans_r["Transition_Label"] = trans_r.apply(
-            lambda r: f"{r['From_description']} to {r['To_description']}", axis=1
-        )
+    trans_r["From_description"] = RECLASS_LABEL_ARR[trans_r["From"].to_numpy()]
+    trans_r["To_description"] = RECLASS_LABEL_ARR[trans_r["To"].to_numpy()]
+    trans_r["Transition_Label"] = (
+        trans_r["From_description"] + " to " + trans_r["To_description"]
+    )
 
+    def write_intensity_outputs():
         intensity_path = os.path.join(results_dir, "NLCD_Intensity_Analysis.xlsx")
-        gain_o.to_csv(
-            os.path.join(results_dir, "NLCD_Intensity_Analysis_Gain_Original.csv"),
-            index=False,
-        )
-        loss_o.to_csv(
-            os.path.join(results_dir, "NLCD_Intensity_Analysis_Loss_Original.csv"),
-            index=False,
-        )
-        trans_o.to_csv(
-            os.path.join(
-                results_dir, "NLCD_Intensity_Analysis_Transition_Original.csv"
-            ),
-            index=False,
-        )
-        gain_r.to_csv(
-            os.path.join(results_dir, "NLCD_Intensity_Analysis_Gain_Reclass.csv"),
-            index=False,
-        )
-        loss_r.to_csv(
-            os.path.join(results_dir, "NLCD_Intensity_Analysis_Loss_Reclass.csv"),
-            index=False,
-        )
-        trans_r.to_csv(
-            os.path.join(results_dir, "NLCD_Intensity_Analysis_Transition_Reclass.csv"),
-            index=False,
-        )
-
-        with pd.ExcelWriter(intensity_path, engine="xlsxwriter") as writer:
-            write_excel_with_title(
-                writer,
-                gain_o,
-                "Gain_Original",
-                "Gain Intensity (Original)",
-                keep_index=False,
+        if include_csv:
+            gain_o.to_csv(
+                os.path.join(results_dir, "NLCD_Intensity_Analysis_Gain_Original.csv"),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                loss_o,
-                "Loss_Original",
-                "Loss Intensity (Original)",
-                keep_index=False,
+            loss_o.to_csv(
+                os.path.join(results_dir, "NLCD_Intensity_Analysis_Loss_Original.csv"),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                trans_o,
-                "Transition_Original",
-                "Transition Intensity (Original)",
-                keep_index=False,
+            trans_o.to_csv(
+                os.path.join(
+                    results_dir, "NLCD_Intensity_Analysis_Transition_Original.csv"
+                ),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                gain_r,
-                "Gain_Reclass",
-                "Gain Intensity (Reclass)",
-                keep_index=False,
+            gain_r.to_csv(
+                os.path.join(results_dir, "NLCD_Intensity_Analysis_Gain_Reclass.csv"),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                loss_r,
-                "Loss_Reclass",
-                "Loss Intensity (Reclass)",
-                keep_index=False,
+            loss_r.to_csv(
+                os.path.join(results_dir, "NLCD_Intensity_Analysis_Loss_Reclass.csv"),
+                index=False,
             )
-            write_excel_with_title(
-                writer,
-                trans_r,
-                "Transition_Reclass",
-                "Transition Intensity (Reclass)",
-                keep_index=False,
+            trans_r.to_csv(
+                os.path.join(
+                    results_dir, "NLCD_Intensity_Analysis_Transition_Reclass.csv"
+                ),
+                index=False,
             )
 
-        # ============================================================
-        # === VISUALIZATION (WITH REPROJECTION & BASEMAP) ============
-        # ============================================================
-        if HAS_MATPLOTLIB and year1_re.shape == year2_re.shape:
-            try:
-                # 1. Calculate basic change array
-                landuse_change = (year1_re.astype(int) * 10) + year2_re.astype(int)
-                from_class = landuse_change // 10
-                to_class = landuse_change % 10
-
-                from_class = np.where(
-                    (from_class >= 1) & (from_class <= 7), from_class, 0
+        if include_xlsx:
+            with pd.ExcelWriter(
+                intensity_path, engine="xlsxwriter", engine_kwargs=XLSX_ENGINE_KWARGS
+            ) as writer:
+                write_excel_with_title(
+                    writer,
+                    gain_o,
+                    "Gain_Original",
+                    "Gain Intensity (Original)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    loss_o,
+                    "Loss_Original",
+                    "Loss Intensity (Original)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    trans_o,
+                    "Transition_Original",
+                    "Transition Intensity (Original)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    gain_r,
+                    "Gain_Reclass",
+                    "Gain Intensity (Reclass)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    loss_r,
+                    "Loss_Reclass",
+                    "Loss Intensity (Reclass)",
+                    keep_index=False,
+                )
+                write_excel_with_title(
+                    writer,
+                    trans_r,
+                    "Transition_Reclass",
+                    "Transition Intensity (Reclass)",
+                    keep_index=False,
                 )
-                to_class = np.where((to_class >= 1) & (to_class <= 7), to_class, 0)
-
-                # 2. Prepare colormap
-                cmap_list = [(0, 0, 0, 0)]
-                for i in range(1, 8):
-                    cmap_list.append(mcolors.to_rgba(CLASS_COLORS[i]))
-                cmap = mcolors.ListedColormap(cmap_list)
-                norm = mcolors.BoundaryNorm(range(0, 9), cmap.N)
-
-                # 3. Loop through classes to generate plots
-                for target in range(1, 8):
-                    mask_target = (to_class == target) & (from_class != target)
-                    if np.count_nonzero(mask_target) == 0:
-                        continue
-
-                    # Create specific mask for this transition
-                    out_arr = np.where(mask_target, from_class, 0).astype(
-                        "uint8"
-                    )  # Ensure type
-
-                    # --- REPROJECTION LOGIC (To align with Contextily/Web Mercator) ---
-                    src_crs = meta_year1["crs"]
-                    src_transform = meta_year1["transform"]
-                    src_height = meta_year1["height"]
-                    src_width = meta_year1["width"]
-
-                    # Calculate bounds of the source
-                    src_bounds = array_bounds(src_height, src_width, src_transform)
-
-                    # Destination: Web Mercator
-                    dst_crs = "EPSG:3857"
-                    # Calculate transform for destination
-                    (
-                        dst_transform,
-                        dst_width,
-                        dst_height,
-                    ) = rasterio.warp.calculate_default_transform(
-                        src_crs, dst_crs, src_width, src_height, *src_bounds
-                    )
-
-                    # Create destination array
-                    arr_3857 = np.zeros((dst_height, dst_width), dtype=out_arr.dtype)
-
-                    # Reproject
-                    rasterio.warp.reproject(
-                        source=out_arr,
-                        destination=arr_3857,
-                        src_transform=src_transform,
-                        src_crs=src_crs,
-                        dst_transform=dst_transform,
-                        dst_crs=dst_crs,
-                        resampling=rasterio.warp.Resampling.nearest,
-                    )
 
-                    # Calculate Extent for Plotting
-                    left = dst_transform.c
-                    right = left + dst_transform.a * dst_width
-                    top = dst_transform.f
-                    bottom = top + dst_transform.e * dst_height
-
-                    # --- PLOTTING ---
-                    fig, ax = plt.subplots(figsize=(10, 10))
-                    # Set limits
-                    ax.set_xlim(left, right)
-                    ax.set_ylim(bottom, top)
-
-                    # Add Basemap (OpenStreetMap via Contextily)
-                    if HAS_CONTEXTILY:
-                        try:
-                            ctx.add_basemap(
-                                ax,
-                                crs=dst_crs,
-                                source=ctx.providers.OpenStreetMap.Mapnik,
-                            )
-                        except Exception as ctx_err:
-                            print(f"Contextily error: {ctx_err}")
-
-                    # Plot the reprojected raster
-                    ax.imshow(
-                        arr_3857,
-                        cmap=cmap,
-                        norm=norm,
-                        extent=[left, right, bottom, top],
-                        interpolation="nearest",
-                        alpha=0.8,  # Slight alpha to see map underneath if needed
-                    )
+    # The four workbooks and their CSVs are independent, so overlap their
+    # serialization and disk IO instead of writing them one after another
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [
+            pool.submit(write_outputs)
+            for write_outputs in (
+                write_transition_outputs,
+                write_normalized_outputs,
+                write_chi_square_outputs,
+                write_intensity_outputs,
+            )
+        ]
+        for future in as_completed(futures):
+            future.result()
 
-                    # Legends & Titles
-                    unique_vals = sorted([v for v in set(arr_3857.flatten()) if v != 0])
-                    legend_handles = [
-                        plt.Rectangle((0, 0), 1, 1, color=CLASS_COLORS.get(v, "gray"))
-                        for v in unique_vals
-                    ]
-                    if legend_handles:
-                        ax.legend(
-                            legend_handles,
-                            [LC_NAMES.get(v, str(v)) for v in unique_vals],
-                            title="Land Class Before Transition",
-                            loc="lower left",
-                            bbox_to_anchor=(1.02, 0.1),
-                        )
+    # ============================================================
+    # === VISUALIZATION (WITH REPROJECTION & BASEMAP) ============
+    # ============================================================
+    if HAS_MATPLOTLIB and year1_re.shape == year2_re.shape:
+        try:
+            # 1. Calculate basic change array. Reclass codes are already 0..7
+            # (0 = unmapped), so the reclassified rasters are the from/to classes
+            from_class = year1_re
+            to_class = year2_re
+            # Target class of every pixel that changed into a real class, else 0;
+            # each target below is then a single compare against this array
+            changed_to = np.where(
+                (to_class != from_class) & (to_class != 0), to_class, np.uint8(0)
+            )
+            changed_counts = np.bincount(changed_to.ravel(), minlength=8)
+
+            # 2. Reproject once to Web Mercator (to align with Contextily).
+            # Nearest-neighbour warping commutes with the per-target masks, so
+            # the from-class and change-target rasters are warped a single
+            # time and each target is masked in Mercator space
+            src_crs = meta_year1["crs"]
+            src_transform = meta_year1["transform"]
+            src_height = meta_year1["height"]
+            src_width = meta_year1["width"]
+            src_bounds = array_bounds(src_height, src_width, src_transform)
+
+            dst_crs = "EPSG:3857"
+            (
+                dst_transform,
+                dst_width,
+                dst_height,
+            ) = rasterio.warp.calculate_default_transform(
+                src_crs, dst_crs, src_width, src_height, *src_bounds
+            )
+            from_3857 = np.zeros((dst_height, dst_width), dtype=np.uint8)
+            changed_to_3857 = np.zeros((dst_height, dst_width), dtype=np.uint8)
+            for source, destination in (
+                (from_class, from_3857),
+                (changed_to, changed_to_3857),
+            ):
+                rasterio.warp.reproject(
+                    source=source,
+                    destination=destination,
+                    src_transform=src_transform,
+                    src_crs=src_crs,
+                    dst_transform=dst_transform,
+                    dst_crs=dst_crs,
+                    resampling=rasterio.warp.Resampling.nearest,
+                )
 
-                    ax.set_title(
+            # Extent for plotting
+            left = dst_transform.c
+            right = left + dst_transform.a * dst_width
+            top = dst_transform.f
+            bottom = top + dst_transform.e * dst_height
+
+            # Basemap tiles depend only on the extent: fetch them once, and
+            # only if at least one map is going to be drawn
+            basemap = None
+            if HAS_CONTEXTILY and changed_counts[1:].any():
+                try:
+                    basemap = fetch_basemap(left, bottom, right, top)
+                except Exception as ctx_err:
+                    print(f"Contextily error: {ctx_err}")
+
+            # 3. One map per target class that received changed pixels
+            extent = (left, right, bottom, top)
+            map_jobs = []
+            for target in range(1, 8):
+                if changed_counts[target] == 0:
+                    continue
+                map_jobs.append(
+                    (
+                        target,
                         f"Land Cover Type Transition from Various Types to Land Use Type -  {LC_NAMES[target]} ({year1}–{year2})",
-                        fontsize=16,
-                    )
-                    ax.axis("off")
-                    plt.tight_layout()
-                    plt.savefig(
                         os.path.join(
                             results_dir,
                             f"what_to_{LC_NAMES[target].replace(' ', '_')}.png",
                         ),
-                        dpi=300,
-                        bbox_inches="tight",
                     )
-                    plt.close()
-
-            except Exception as e:
-                print(f"Viz error: {e}")
-                import traceback
+                )
 
-                traceback.print_exc()
+            if PLOT_WORKERS > 1 and len(map_jobs) > 1:
+                # Rasters and tiles go to shared memory once per request;
+                # each worker masks its own target in Mercator space
+                shared = [share_array(from_3857), share_array(changed_to_3857)]
+                shared_basemap = None
+                if basemap is not None:
+                    shared.append(share_array(basemap[0]))
+                    shared_basemap = (shared[2][1], basemap[1], basemap[2])
+                futures = []
+                try:
+                    for target, title, out_path in map_jobs:
+                        futures.append(
+                            _plot_pool().submit(
+                                render_change_map_shared,
+                                target,
+                                shared[0][1],
+                                shared[1][1],
+                                extent,
+                                shared_basemap,
+                                title,
+                                out_path,
+                            )
+                        )
+                    for future in futures:
+                        future.result()
+                finally:
+                    # No job may still be attaching when the blocks go away
+                    wait(futures)
+                    for shm, _ in shared:
+                        shm.close()
+                        shm.unlink()
+            else:
+                for target, title, out_path in map_jobs:
+                    # Mask for this transition, already on the Mercator grid
+                    arr_3857 = np.where(
+                        changed_to_3857 == target, from_3857, np.uint8(0)
+                    )
+                    render_change_map(arr_3857, extent, basemap, title, out_path)
 
-        # ============================================================
-        # === INTEGRATION STEP: VEGETATION STRUCTURE =================
-        # ============================================================
-        try:
-            # We use out_tif_year2 which is the cropped Year 2 raster we created earlier.
-            veg_structure_csv = os.path.join(results_dir, "vegetation_structure.csv")
-            export_vegetation_structure(out_tif_year2, veg_structure_csv)
         except Exception as e:
-            print(f"Vegetation Structure Logic Error: {e}")
+            print(f"Viz error: {e}")
             import traceback
 
             traceback.print_exc()
 
-        # Metadata
-        metadata = {
-            "analysis_date": datetime.now().isoformat(),
-            "year1": year1,
-            "year2": year2,
-            "total_pixels": int(total_pix),
-            "chi_square_original": chi_orig["chi2"],
-            "chi_square_p_value_original": chi_orig["p"],
-            "fragstats_status": "Success" if HAS_RPY2 else "Skipped (rpy2 missing)",
-        }
-        with open(os.path.join(results_dir, "analysis_metadata.json"), "w") as f:
-            json.dump(metadata, f, indent=2)
-
-        with open(os.path.join(results_dir, "input_polygon.geojson"), "w") as f:
-            json.dump(geojson_data, f, indent=2)
-
-        # ZIP
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for root, dirs, files in os.walk(results_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zf.write(file_path, os.path.relpath(file_path, results_dir))
-        zip_buffer.seek(0)
-
-        shutil.rmtree(output_dir, ignore_errors=True)
+    # ============================================================
+    # === INTEGRATION STEP: VEGETATION STRUCTURE =================
+    # ============================================================
+    try:
+        # We use out_tif_year2 which is the cropped Year 2 raster we created earlier.
+        veg_structure_csv = os.path.join(results_dir, "vegetation_structure.csv")
+        export_vegetation_structure(out_tif_year2, veg_structure_csv)
+    except Exception as e:
+        print(f"Vegetation Structure Logic Error: {e}")
+        import traceback
+
+        traceback.print_exc()
+
+    # Metadata
+    metadata = {
+        "analysis_date": datetime.now().isoformat(),
+        "year1": year1,
+        "year2": year2,
+        "total_pixels": int(total_pix),
+        "chi_square_original": chi_orig["chi2"],
+        "chi_square_p_value_original": chi_orig["p"],
+        "fragstats_status": fragstats_status,
+    }
+    with open(os.path.join(results_dir, "analysis_metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    with open(os.path.join(results_dir, "input_polygon.geojson"), "w") as f:
+        json.dump(geojson_data, f, indent=2)
+
+    # ZIP entries; the archive itself is built while it is being sent
+    skipped = set() if include_cropped_rasters else {out_tif_year1, out_tif_year2}
+    return scan_zip_entries(results_dir, skipped)
+
+
+# ============================================================
+# === MAIN ENDPOINT ==========================================
+# ============================================================
+@app.post("/api/analyze")
+async def analyze(request: AnalysisRequest):
+    try:
+        output_dir = tempfile.mkdtemp(prefix="nlcd_analysis_")
+        os.makedirs(os.path.join(output_dir, "results"), exist_ok=True)
+
+        geojson_data = request.geojson
+        year1 = request.year1
+        year2 = request.year2
+        print(f"Starting analysis for years {year1} to {year2}")
+
+        # --- LOAD GEOMETRY (GeoJSON is WGS84; parse straight to shapely) ---
+        if geojson_data.get("type") == "Feature":
+            raw_geoms = [geojson_data.get("geometry")]
+        elif geojson_data.get("type") == "FeatureCollection":
+            raw_geoms = [f.get("geometry") for f in geojson_data.get("features", [])]
+        elif geojson_data.get("type") in ["Polygon", "MultiPolygon"]:
+            raw_geoms = [geojson_data]
+        else:
+            raise HTTPException(status_code=400, detail="Invalid GeoJSON format")
+
+        if not raw_geoms:
+            raise HTTPException(
+                status_code=400, detail="GeoJSON contains no valid geometries"
+            )
+
+        try:
+            tif_path_year1 = get_tif_path(year1)
+            tif_path_year2 = get_tif_path(year2)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        geoms = [shape(g) for g in raw_geoms if g]
+        if not geoms:
+            raise HTTPException(status_code=400, detail="No valid geometries found")
+        geom_key = json.dumps(raw_geoms, sort_keys=True, separators=(",", ":"))
+
+        # Rasterize the AOI once, crop both years concurrently with it, then run
+        # the rest of the pipeline on a worker thread so the event loop stays
+        # free for other requests
+        aoi = await anyio.to_thread.run_sync(build_aoi_mask, tif_path_year2, geoms)
+        crop_year1, crop_year2 = await asyncio.gather(
+            anyio.to_thread.run_sync(read_crop, tif_path_year1, aoi, geom_key),
+            anyio.to_thread.run_sync(read_crop, tif_path_year2, aoi, geom_key),
+        )
+        zip_entries = await anyio.to_thread.run_sync(
+            run_analysis,
+            output_dir,
+            geojson_data,
+            year1,
+            year2,
+            crop_year1,
+            crop_year2,
+            request.include_cropped_rasters,
+            request.include_xlsx,
+            request.include_csv,
+        )
+
         return StreamingResponse(
-            zip_buffer,
+            iter_zip(zip_entries),
             media_type="application/zip",
             headers={
                 "Content-Disposition": f"attachment; filename=analysis_{year1}_{year2}.zip"
             },
+            background=BackgroundTask(shutil.rmtree, output_dir, ignore_errors=True),
         )
 
     except HTTPException:
@@ -1577,7 +2397,11 @@ async def analyze(request: AnalysisRequest):
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "rpy2_installed": HAS_RPY2}
+    return {
+        "status": "healthy",
+        "rpy2_installed": HAS_RPY2,
+        "pylandstats_installed": HAS_PYLANDSTATS,
+    }
 
 
 @app.get("/")
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+import rasterio
+from rasterio.mask import mask
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+
+# Polygon in the raster's own CRS (EPSG:4326), so no reprojection is involved
+POLYGON = {
+    "type": "Polygon",
+    "coordinates": [
+        [
+            [-80.0, 40.0],
+            [-79.91, 39.995],
+            [-79.915, 39.93],
+            [-79.995, 39.94],
+            [-80.0, 40.0],
+        ]
+    ],
+}
+
+
+def write_raster(path, nodata_pixels):
+    rng = np.random.default_rng(0)
+    codes = np.array(sorted(main.RECLASS_DICT), dtype=np.uint8)
+    arr = codes[rng.integers(0, len(codes), size=(40, 50))]
+    for row, col in nodata_pixels:
+        arr[row, col] = 250
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=arr.shape[0],
+        width=arr.shape[1],
+        count=1,
+        dtype="uint8",
+        crs="EPSG:4326",
+        transform=from_origin(-80.01, 40.01, 0.0025, 0.0025),
+        nodata=250,
+    ) as dst:
+        dst.write(arr, 1)
+
+
+def test_crop_matches_rasterio_mask_with_nodata_inside_aoi(tmp_path):
+    path = str(tmp_path / "nlcd.tif")
+    # (20, 20) lies well inside the polygon, (1, 1) outside it
+    write_raster(path, nodata_pixels=[(20, 20), (21, 22), (1, 1)])
+
+    aoi = main.build_aoi_mask(path, [POLYGON])
+    band, meta = main.read_crop(path, aoi)
+
+    with rasterio.open(path) as src:
+        expected, expected_transform = mask(src, [POLYGON], crop=True, nodata=0)
+
+    assert band.dtype == np.uint8
+    assert not (band == 250).any()
+    np.testing.assert_array_equal(band, expected[0])
+    assert meta["transform"] == expected_transform
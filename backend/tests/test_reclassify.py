@@ -0,0 +1,34 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+
+CODES = [0, 11, 12, 21, 31, 41, 52, 73, 90, 95, 250, 255]
+EXPECTED = [0, 1, 1, 2, 7, 3, 4, 6, 5, 5, 0, 0]
+
+
+def test_reclassify_uint8_maps_unlisted_codes_to_zero():
+    out = main.reclassify(np.array(CODES, dtype=np.uint8), main.RECLASS_DICT)
+    assert out.dtype == np.uint8
+    np.testing.assert_array_equal(out, EXPECTED)
+
+
+def test_reclassify_wide_dtype_matches_uint8_path():
+    wide = np.array(CODES + [-1, 1000], dtype=np.int32)
+    out = main.reclassify(wide, main.RECLASS_DICT)
+    assert out.dtype == np.uint8
+    np.testing.assert_array_equal(out, EXPECTED + [0, 0])
+
+
+def test_transition_counts_reclass_matches_reclassify():
+    rng = np.random.default_rng(0)
+    a1 = np.array(CODES, dtype=np.uint8)[rng.integers(0, len(CODES), 5000)]
+    a2 = np.array(CODES, dtype=np.uint8)[rng.integers(0, len(CODES), 5000)]
+    counts, r1, r2 = main.transition_counts_reclass(a1, a2)
+    np.testing.assert_array_equal(r1, main.reclassify(a1, main.RECLASS_DICT))
+    np.testing.assert_array_equal(r2, main.reclassify(a2, main.RECLASS_DICT))
+    np.testing.assert_array_equal(counts, main.transition_counts(a1, a2))